@@ -1,15 +1,53 @@
 import os
 import traceback
-from time import sleep
+from threading import Condition, Lock
+from time import sleep, time
 
 import psycopg2
-from psycopg2.errorcodes import UNIQUE_VIOLATION
-from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+from psycopg2.errorcodes import UNIQUE_VIOLATION, INVALID_SQL_STATEMENT_NAME
+from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED, TRANSACTION_STATUS_IDLE, connection
 
-from common import logger, SQL_DEBUG
+from common import logger, SQL_DEBUG, MIH_MAX_DISTANCE, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_PING_INTERVAL, \
+    REPLICA_MAX_LAG, REPLICA_LAG_CHECK_INTERVAL, REPLICA_MISS_FALLBACK
+from hash_util import hash_to_int, hash_chunks, chunk_neighbours, HASH_BYTES, HASH_CHUNKS
 from img_util import thumb_path
 from util import clean_url
 
+# Full-text search documents. Post titles weigh more than their self-text
+POST_TSV = "setweight(to_tsvector('english', coalesce(%s, '')), 'A') || " \
+           "setweight(to_tsvector('english', coalesce(%s, '')), 'B')"
+COMMENT_TSV = "to_tsvector('english', coalesce(%s, ''))"
+
+# Statements of the ingest hot path. They are prepared once per connection, then executed by name
+PREPARED_STATEMENTS = {
+    "image_from_url":
+        "SELECT i.id FROM imageurls INNER JOIN images i ON i.id = imageurls.imageid WHERE clean_url = $1",
+    "image_from_sha1": "SELECT id FROM images WHERE sha1 = $1",
+    "video_from_url":
+        "SELECT v.id FROM videourls INNER JOIN videos v ON v.id = videourls.videoid WHERE clean_url = $1",
+    "video_from_sha1": "SELECT id FROM videos WHERE sha1 = $1",
+    "postid_from_hexid": "SELECT id FROM posts WHERE hexid = $1",
+    "commentid_from_hexid": "SELECT id FROM comments WHERE hexid = $1",
+    "insert_post":
+        "INSERT INTO posts (hexid, title, url, text, author, permalink,"
+        " subreddit, comments, ups, downs, score, created, is_self, over_18, tsv)"
+        " VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14," + POST_TSV % ("$2", "$4") + ")"
+        " ON CONFLICT DO NOTHING RETURNING id",
+    "insert_comment":
+        "INSERT INTO comments (postid, hexid, author, body, ups, downs, created, tsv)"
+        " VALUES ($1,$2,$3,$4,$5,$6,$7," + COMMENT_TSV % ("$4",) + ") RETURNING id",
+    "insert_image":
+        "INSERT INTO images (width, height, bytes, hash, sha1) VALUES ($1,$2,$3,$4,$5) ON CONFLICT DO NOTHING "
+        "RETURNING id",
+    "insert_image_hash_chunks":
+        "INSERT INTO imagehashchunks (imageid, chunk, value) VALUES " +
+        ", ".join("($1,%d,$%d)" % (i, i + 2) for i in range(HASH_CHUNKS)) + " ON CONFLICT DO NOTHING",
+    "insert_imageurl":
+        "INSERT INTO imageurls (url, clean_url, imageid, albumid, postid, commentid) VALUES ($1,$2,$3,$4,$5,$6)",
+    "insert_videourl":
+        "INSERT INTO videourls (url, clean_url, videoid, postid, commentid) VALUES ($1,$2,$3,$4,$5)",
+}
+
 
 class SearchResult:
     __slots__ = "permalink", "subreddit", "created", \
@@ -86,9 +124,9 @@ class PostSearchResult(SearchResult):
 
 
 class ImageItem:
-    __slots__ = "url", "width", "height", "size", "thumb", "sha1", "album_url"
+    __slots__ = "url", "width", "height", "size", "thumb", "sha1", "album_url", "distance", "image_id"
 
-    def __init__(self, url, width, height, size, thumb, sha1, album_url):
+    def __init__(self, url, width, height, size, thumb, sha1, album_url, distance=None, image_id=None):
         self.url = url
         self.width = width
         self.height = height
@@ -96,6 +134,8 @@ class ImageItem:
         self.sha1 = sha1
         self.thumb = thumb
         self.album_url = album_url
+        self.distance = distance
+        self.image_id = image_id
 
     def json(self):
         return {
@@ -107,15 +147,17 @@ class ImageItem:
             "sha1": self.sha1,
             "thumb": self.thumb,
             "album_url": self.album_url,
+            "distance": self.distance,
+            "image_id": self.image_id,
         }
 
 
 class VideoItem:
     __slots__ = "url", "width", "height", "size", "bitrate", "codec", "format", "sha1", "duration", \
-                "frames", "video_id"
+                "frames", "video_id", "matched_frames"
 
     def __init__(self, url, width, height, size, bitrate, codec, format, duration,
-                 frames, sha1, video_id):
+                 frames, sha1, video_id, matched_frames=None):
         self.url = url
         self.width = width
         self.height = height
@@ -127,6 +169,7 @@ class VideoItem:
         self.frames = frames
         self.sha1 = sha1
         self.video_id = video_id
+        self.matched_frames = matched_frames
 
     def json(self):
         return {
@@ -142,24 +185,148 @@ class VideoItem:
             "format": self.format,
             "duration": self.duration,
             "frames": self.frames,
+            "matched_frames": self.matched_frames,
         }
 
 
-class PgConn:
-    def __init__(self, conn, conn_str):
-        self.conn = conn
+# SQL expression of a bytea hash as a bit string, for bit_count(a # b) hamming distances
+_HASH_BITS = "('x' || encode(%%s, 'hex'))::bit(%d)" % (HASH_BYTES * 8)
+
+
+class ConnectionPool:
+    """
+        Thread-safe pool of connections to one database.
+        Keeps min_size connections open, opens more on demand up to max_size and blocks checkouts
+        beyond that. Connections idle for more than DB_POOL_PING_INTERVAL seconds are checked
+        before being handed out, broken ones are replaced.
+    """
+    _shared = {}
+    _shared_lock = Lock()
+
+    def __init__(self, conn_str, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX):
         self.conn_str = conn_str
-        self.cur = conn.cursor()
+        self.max_size = max_size
+        self._idle = [(self._connect(), time()) for _ in range(min_size)]  # (conn, returned at)
+        self._size = min_size
+        self._cond = Condition()
+
+    def _connect(self):
+        return psycopg2.connect(self.conn_str, connection_factory=PreparedConnection)
+
+    @classmethod
+    def shared(cls, conn_str, min_size=DB_POOL_MIN):
+        """ Pool of conn_str shared by every DB instance of the process """
+        with cls._shared_lock:
+            if conn_str not in cls._shared:
+                cls._shared[conn_str] = cls(conn_str, min_size=min_size)
+            return cls._shared[conn_str]
+
+    def getconn(self):
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn = None
+                self._size += 1
+
+        if conn is not None:
+            if self._is_healthy(conn, returned_at):
+                return conn
+            logger.warning("Replacing broken database connection")
+            conn.close()
+
+        try:
+            return self._connect()
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        """ Returns a connection to the pool, rolling back any open transaction. discard closes it instead """
+        if not discard and not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard or conn.closed:
+            conn.close()
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time()))
+            self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(conn, returned_at):
+        if conn.closed:
+            return False
+        if time() - returned_at < DB_POOL_PING_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+class PreparedConnection(connection):
+    """ Connection that remembers which PREPARED_STATEMENTS were prepared on it """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class PgConn:
+    def __init__(self, pool, fallback=None, on_fallback=None):
+        """
+            * fallback - pool used instead of pool when its database can't be reached
+            * on_fallback - called with the connection error when switching to fallback
+        """
+        self.pool = pool
+        self.conn = None
+        self.cur = None
+        self._fallback = fallback
+        self._on_fallback = on_fallback
 
     def __enter__(self):
+        try:
+            self.conn = self.pool.getconn()
+        except psycopg2.OperationalError as e:
+            if self._fallback is None:
+                raise
+            self._use_fallback(e)
+            self.conn = self.pool.getconn()
+        self.cur = self.conn.cursor()
         return self
 
-    def exec(self, query_string, args=None):
+    def _use_fallback(self, err):
+        self._on_fallback(err)
+        self.pool, self._fallback = self._fallback, None
+
+    def _execute(self, query_string, args, prepared):
+        if prepared:
+            if query_string not in self.conn.prepared:
+                self.cur.execute("PREPARE %s AS %s" % (query_string, PREPARED_STATEMENTS[query_string]))
+                self.conn.prepared.add(query_string)
+            query_string = "EXECUTE %s (%s)" % (query_string, ",".join(["%s"] * len(args)))
+        self.cur.execute(query_string, args)
+
+    def exec(self, query_string, args=None, prepared=False):
+        """ prepared: query_string is the name of one of the PREPARED_STATEMENTS """
         if args is None:
             args = []
         while True:
             try:
-                self.cur.execute(query_string, args)
+                self._execute(query_string, args, prepared)
                 break
             except psycopg2.Error as e:
                 if e.pgcode == UNIQUE_VIOLATION:
@@ -167,7 +334,8 @@ class PgConn:
                 traceback.print_stack()
                 self._handle_err(e, query_string, args)
 
-    def query(self, query_string, args=None, read_committed=False):
+    def query(self, query_string, args=None, read_committed=False, prepared=False):
+        """ prepared: query_string is the name of one of the PREPARED_STATEMENTS """
         if read_committed:
             self.conn.set_isolation_level(ISOLATION_LEVEL_READ_COMMITTED)
         while True:
@@ -176,7 +344,7 @@ class PgConn:
                     logger.debug(query_string)
                     logger.debug("With args " + str(args))
 
-                self.cur.execute(query_string, args)
+                self._execute(query_string, args, prepared)
                 res = self.cur.fetchall()
 
                 if SQL_DEBUG:
@@ -190,9 +358,21 @@ class PgConn:
 
     def _handle_err(self, err, query, args):
         logger.warn("Error during query '%s' with args %s: %s %s (%s)" % (query, args, type(err), err, err.pgcode))
-        self.conn = psycopg2.connect(self.conn_str)
+        if err.pgcode == INVALID_SQL_STATEMENT_NAME:
+            self.conn.prepared.clear()
+        # Connection errors get a new connection, others only roll back the transaction
+        connection_error = isinstance(err, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        self.pool.putconn(self.conn, discard=connection_error)
+        self.conn = None
+        if connection_error and self._fallback is not None:
+            self._use_fallback(err)
+        while self.conn is None:
+            sleep(0.1)
+            try:
+                self.conn = self.pool.getconn()
+            except psycopg2.OperationalError as e:
+                logger.warning("Could not reconnect to the database: %s" % (e, ))
         self.cur = self.conn.cursor()
-        sleep(0.1)
 
     def __exit__(self, type, value, traceback):
         try:
@@ -200,15 +380,19 @@ class PgConn:
             self.cur.close()
         except:
             pass
+        self.pool.putconn(self.conn)
 
 
 class DB:
 
-    def __init__(self, db_file, **schemas):
+    def __init__(self, db_file, result_cache=None, read_db_file=None, **schemas):
         """
         Initializes database.
         Attempts to creates tables with schemas if needed.
-            * db_file - Name of the database file.
+            * db_file - Name of the database file. Connections are taken from a pool shared by
+                every DB instance of the process with the same db_file
+            * result_cache - Optional ResultCache for build_result_for_images/build_results_for_videos
+            * read_db_file - Optional read replica, for the search queries (see get_read_conn())
             * schemas - A python dictionary where:
                 KEY is the table name,
                 VALUE is that table's schema.
@@ -221,7 +405,13 @@ class DB:
             If the tables already exist, the existing tables remain unaltered.
         """
         self.db_file = db_file
-        self.conn = psycopg2.connect(self.db_file)
+        self.result_cache = result_cache
+        self.pool = ConnectionPool.shared(db_file)
+        # Replica connections are only opened when used, an unreachable replica doesn't prevent startup
+        self.read_pool = ConnectionPool.shared(read_db_file, min_size=0) \
+            if read_db_file and read_db_file != db_file else None
+        self._replica_ok = True
+        self._lag_checked_at = 0
 
         # Don't create tables if not supplied.
         if schemas is not None and schemas != {} and schemas:
@@ -231,7 +421,84 @@ class DB:
                 self._create_table(key, schemas[key])
 
     def get_conn(self):
-        return PgConn(self.conn, self.db_file)
+        return PgConn(self.pool)
+
+    def get_read_conn(self):
+        """
+            Connection for search queries: to the read replica, unless there is none, it lags behind
+            or can't be reached (the query then runs on the primary)
+        """
+        pool = self._read_pool()
+        if pool is self.pool:
+            return PgConn(pool)
+        return PgConn(pool, fallback=self.pool, on_fallback=self._replica_failed)
+
+    def _getconn_read(self):
+        """ (pool, connection) for a named cursor, see get_read_conn() """
+        pool = self._read_pool()
+        try:
+            return pool, pool.getconn()
+        except psycopg2.OperationalError as e:
+            if pool is self.pool:
+                raise
+            self._replica_failed(e)
+            return self.pool, self.pool.getconn()
+
+    def _replica_failed(self, err):
+        """ Sends searches to the primary until the next lag check """
+        if self._replica_ok:
+            logger.warning("Replica unreachable, sending searches to the primary: %s" % (err, ))
+        self._replica_ok = False
+        self._lag_checked_at = time()
+
+    def _read_pool(self):
+        if self.read_pool is None:
+            return self.pool
+
+        now = time()
+        if now - self._lag_checked_at > REPLICA_LAG_CHECK_INTERVAL:
+            self._lag_checked_at = now
+            lag = self.get_replica_lag()
+            if (lag <= REPLICA_MAX_LAG) != self._replica_ok:
+                logger.warning("Replica lag is %.1fs, sending searches to the %s" %
+                               (lag, "replica" if lag <= REPLICA_MAX_LAG else "primary"))
+            self._replica_ok = lag <= REPLICA_MAX_LAG
+
+        return self.read_pool if self._replica_ok else self.pool
+
+    def get_replica_lag(self):
+        """
+            Seconds of changes the read replica has yet to replay. Infinity if it can't be reached or is not
+            streaming from the primary (its WAL receiver stopped): it could be arbitrarily far behind
+        """
+        try:
+            conn = self.read_pool.getconn()
+        except psycopg2.Error:
+            return float("inf")
+        discard = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+                            " WHEN NOT EXISTS(SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') "
+                            "  THEN 'Infinity'::float8 "
+                            " WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                            " ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END")
+                return float(cur.fetchone()[0] or 0)
+        except psycopg2.Error:
+            discard = True
+            return float("inf")
+        finally:
+            self.read_pool.putconn(conn, discard=discard)
+
+    def _query_read(self, query_string, args):
+        """ Runs a lookup on the read replica, and again on the primary if the replica has no rows (yet) """
+        with self.get_read_conn() as conn:
+            res = conn.query(query_string, args, read_committed=True)
+
+        if not res and self.read_pool is not None and REPLICA_MISS_FALLBACK:
+            with self.get_conn() as conn:
+                res = conn.query(query_string, args, read_committed=True)
+        return res
 
     def _create_table(self, table_name, schema):
         """Creates new table with schema"""
@@ -240,82 +507,152 @@ class DB:
 
     def get_image_from_url(self, url):
         with self.get_conn() as conn:
-            res = conn.query("SELECT i.id from imageurls "
-                             "INNER JOIN images i on i.id = imageurls.imageid "
-                             "WHERE clean_url = %s", (clean_url(url),))
+            res = conn.query("image_from_url", (clean_url(url),), prepared=True)
 
         return None if not res else res[0][0]
 
     def get_image_hash_from_url(self, url):
-        with self.get_conn() as conn:
-            res = conn.query("SELECT i.hash from imageurls "
-                             "INNER JOIN images i on i.id = imageurls.imageid "
-                             "WHERE clean_url = %s", (clean_url(url),), read_committed=True)
+        res = self._query_read("SELECT i.hash from imageurls "
+                               "INNER JOIN images i on i.id = imageurls.imageid "
+                               "WHERE clean_url = %s", (clean_url(url),))
 
         return None if not res else res[0][0]
 
-    def get_similar_images(self, hash, distance=0):
-        with self.get_conn() as conn:
-            # TODO: LIMIT X
+    def get_similar_images(self, hash, distance=0, k=None, after=None):
+        """
+            Returns up to k (id, distance) tuples of images within <distance> of hash, ordered by (distance, id).
+            Distances are computed and ranked by postgres (bit_count, PostgreSQL 14+), only the top k rows are sent
+            * after - optional (distance, id) cursor, only images ordered after it are returned
+        """
+        after = after or (-1, 0)
+        with self.get_read_conn() as conn:
             if distance <= 0:
-                res = conn.query("SELECT id from images WHERE hash = %s", (hash,),
-                                 read_committed=True)
-            else:
-                res = conn.query(
-                    "SELECT id FROM images WHERE hash_is_within_distance(hash, %s, %s)",
-                    (hash, distance,), read_committed=True,
+                if after[0] > 0:
+                    return []
+                # Identical hashes have all of their substrings in common, there is no index on images.hash
+                return conn.query(
+                    "SELECT imageid, 0 FROM imagehashchunks WHERE imageid > %s AND (" +
+                    " OR ".join("(chunk = %d AND value = %%s)" % i for i in range(HASH_CHUNKS)) +
+                    ") GROUP BY imageid HAVING count(*) = %d ORDER BY imageid LIMIT %%s" % HASH_CHUNKS,
+                    (after[1] if after[0] == 0 else 0, *hash_chunks(hash_to_int(hash)), k), read_committed=True
                 )
 
-        return [] if not res else [row[0] for row in res]
+            if distance <= MIH_MAX_DISTANCE:
+                # Candidates share at least one substring within distance // HASH_CHUNKS
+                radius = distance // HASH_CHUNKS
+                probes = [chunk_neighbours(value, radius) for value in hash_chunks(hash_to_int(hash))]
+                where = "id IN (SELECT imageid FROM imagehashchunks WHERE " + \
+                        " OR ".join("(chunk = %d AND value = ANY(%%s))" % i for i in range(HASH_CHUNKS)) + \
+                        ") AND hash_is_within_distance(hash, %s, %s)"
+                args = (*probes, hash, distance)
+            else:
+                where = "hash_is_within_distance(hash, %s, %s)"
+                args = (hash, distance)
+
+            distance_sql = "bit_count(" + _HASH_BITS % "hash" + " # " + _HASH_BITS % "%s" + ")"
+            return conn.query(
+                "SELECT id, " + distance_sql + " AS distance FROM images WHERE " + where +
+                " AND (" + distance_sql + ", id) > (%s, %s) ORDER BY distance, id LIMIT %s",
+                (hash, *args, hash, *after, k), read_committed=True,
+            )
 
-    def get_similar_videos_by_hash(self, hashes, distance, frame_count):
+    def get_image_hashes(self, min_id=0, shard=None, primary=False):
+        """
+            Yields (id, hash) for every image with id > min_id in id order, streamed with a server-side cursor
+            * shard - optional (shard, shard count) tuple, only yields images where id % shard count = shard
+            * primary - read from the primary even when a replica is configured
+        """
+        pool, conn = (self.pool, self.pool.getconn()) if primary else self._getconn_read()
+        try:
+            with conn.cursor(name="image_hashes") as cur:
+                cur.itersize = 100000
+                if shard is None:
+                    cur.execute("SELECT id, hash FROM images WHERE id > %s ORDER BY id", (min_id,))
+                else:
+                    cur.execute("SELECT id, hash FROM images WHERE id > %s AND id %% %s = %s ORDER BY id",
+                                (min_id, shard[1], shard[0]))
+                for row in cur:
+                    yield row
+        finally:
+            pool.putconn(conn)
+
+    def get_video_frame_hashes(self, min_id=0, shard=None):
+        """
+            Yields (frame id, video id, hash) for every video frame with id > min_id in id order,
+            streamed with a server-side cursor
+            * shard - optional (shard, shard count) tuple, only yields frames where videoid % shard count = shard
+        """
+        pool, conn = self._getconn_read()
+        try:
+            with conn.cursor(name="video_frame_hashes") as cur:
+                cur.itersize = 100000
+                if shard is None:
+                    cur.execute("SELECT id, videoid, hash FROM videoframes WHERE id > %s ORDER BY id", (min_id,))
+                else:
+                    cur.execute("SELECT id, videoid, hash FROM videoframes "
+                                "WHERE id > %s AND videoid %% %s = %s ORDER BY id",
+                                (min_id, shard[1], shard[0]))
+                for row in cur:
+                    yield row
+        finally:
+            pool.putconn(conn)
+
+    def get_similar_videos_by_hash(self, hashes, distance, frame_count, k=None):
+        """ Returns up to k (id, matched frame count) tuples, most matched frames first """
         hashes = list(set(hashes))
-        with self.get_conn() as conn:
-            # TODO: LIMIT X
+        with self.get_read_conn() as conn:
             if distance == 0:
                 res = conn.query(
-                    "SELECT videos.id from videoframes "
+                    "SELECT videos.id, COUNT(videoframes.id) from videoframes "
                     "INNER JOIN videos on videos.id = videoid "
                     "WHERE hash_equ_any(hash, %s) "
                     "GROUP BY videos.id "
-                    "HAVING COUNT(videoframes.id) >= %s",
-                    (b''.join(hashes), frame_count), read_committed=True
+                    "HAVING COUNT(videoframes.id) >= %s "
+                    "ORDER BY COUNT(videoframes.id) DESC LIMIT %s",
+                    (b''.join(hashes), frame_count, k), read_committed=True
                 )
             else:
                 res = conn.query(
-                    "SELECT videos.id from videoframes "
+                    "SELECT videos.id, COUNT(videoframes.id) from videoframes "
                     "INNER JOIN videos on videos.id = videoid "
                     "WHERE hash_is_within_distance_any(hash, %s, %s) "
                     "GROUP BY videos.id "
-                    "HAVING COUNT(videoframes.id) >= %s",
-                    (b''.join(hashes), distance, frame_count), read_committed=True,
+                    "HAVING COUNT(videoframes.id) >= %s "
+                    "ORDER BY COUNT(videoframes.id) DESC LIMIT %s",
+                    (b''.join(hashes), distance, frame_count, k), read_committed=True,
                 )
 
-        return [] if not res else [row[0] for row in res]
+        return [] if not res else [(row[0], row[1]) for row in res]
 
     def get_image_from_sha1(self, sha1):
         with self.get_conn() as conn:
-            res = conn.query("SELECT id from images "
-                             "WHERE sha1=%s", (sha1,))
+            res = conn.query("image_from_sha1", (sha1,), prepared=True)
 
         return None if not res else res[0][0]
 
     def insert_imageurl(self, url, imageid, albumid, postid, commentid):
         with self.get_conn() as conn:
-            conn.exec("INSERT INTO imageurls (url, clean_url, imageid, albumid, postid, commentid) "
-                      "VALUES (%s,%s,%s,%s,%s,%s)", (url, clean_url(url), imageid, albumid, postid, commentid))
+            conn.exec("insert_imageurl", (url, clean_url(url), imageid, albumid, postid, commentid), prepared=True)
 
     def insert_image(self, imhash, width, height, size, sha1):
         with self.get_conn() as conn:
-            res = conn.query("INSERT INTO images (width, height, bytes, hash, sha1) "
-                             "VALUES (%s,%s,%s,%s,%s) ON CONFLICT DO NOTHING returning id ",
-                             (width, height, size, imhash, sha1))
+            res = conn.query("insert_image", (width, height, size, imhash, sha1), prepared=True)
             # race condition: image was inserted after the existing_by_sha1 check
             if not res:
-                res = conn.query("SELECT id FROM images WHERE sha1=%s", (sha1,))
+                res = conn.query("image_from_sha1", (sha1,), prepared=True)
+            else:
+                self._insert_hash_chunks(conn, res[0][0], imhash)
 
         return None if not res else res[0][0]
 
+    def insert_image_hash_chunks(self, imageid, imhash):
+        with self.get_conn() as conn:
+            self._insert_hash_chunks(conn, imageid, imhash)
+
+    @staticmethod
+    def _insert_hash_chunks(conn, imageid, imhash):
+        conn.exec("insert_image_hash_chunks", (imageid, *hash_chunks(hash_to_int(imhash))), prepared=True)
+
     def insert_video(self, sha1, size=0, info={}):
         with self.get_conn() as conn:
             res = conn.query("INSERT INTO videos "
@@ -331,8 +668,7 @@ class DB:
 
     def insert_videourl(self, url, video_id, postid, commentid):
         with self.get_conn() as conn:
-            conn.exec("INSERT INTO videourls (url, clean_url, videoid, postid, commentid) "
-                      "VALUES (%s,%s,%s,%s,%s)", (url, clean_url(url), video_id, postid, commentid))
+            conn.exec("insert_videourl", (url, clean_url(url), video_id, postid, commentid), prepared=True)
 
     def insert_video_frames(self, video_id, frames):
         with self.get_conn() as conn:
@@ -347,28 +683,23 @@ class DB:
 
     def get_video_from_url(self, url):
         with self.get_conn() as conn:
-            res = conn.query("SELECT v.id from videourls "
-                             "INNER JOIN videos v on v.id = videourls.videoid "
-                             "WHERE clean_url = %s", (clean_url(url),))
+            res = conn.query("video_from_url", (clean_url(url),), prepared=True)
 
         return None if not res else res[0][0]
 
     def get_video_from_sha1(self, sha1):
         with self.get_conn() as conn:
-            res = conn.query("SELECT id from videos "
-                             "WHERE sha1=%s", (sha1,))
+            res = conn.query("video_from_sha1", (sha1,), prepared=True)
         return None if not res else res[0][0]
 
     def get_videoframes(self, video_id):
-        with self.get_conn() as conn:
-            res = conn.query("SELECT id from videoframes "
-                             "WHERE videoid=%s", (video_id,), read_committed=True)
+        res = self._query_read("SELECT id from videoframes "
+                               "WHERE videoid=%s", (video_id,))
         return None if not res else [r[0] for r in res]
 
     def get_video_hashes(self, video_id):
-        with self.get_conn() as conn:
-            res = conn.query("SELECT hash from videoframes "
-                             "WHERE videoid=%s", (video_id,), read_committed=True)
+        res = self._query_read("SELECT hash from videoframes "
+                               "WHERE videoid=%s", (video_id,))
         return None if not res else [r[0] for r in res]
 
     def get_or_create_album(self, url):
@@ -384,10 +715,9 @@ class DB:
     def insert_comment(self, postid, comment_id, comment_author,
                        comment_body, comment_upvotes, comment_downvotes, comment_created_utc):
         with self.get_conn() as conn:
-            res = conn.query("INSERT INTO comments (postid, hexid, author, body, ups, downs, created)"
-                             " VALUES (%s,%s,%s,%s,%s,%s,%s) RETURNING ID",
+            res = conn.query("insert_comment",
                              (postid, comment_id, comment_author, comment_body, comment_upvotes, comment_downvotes,
-                              comment_created_utc))
+                              comment_created_utc), prepared=True)
         return None if not res else res[0][0]
 
     def insert_post(self, post_id, title, url, selftext,
@@ -397,176 +727,217 @@ class DB:
 
         with self.get_conn() as conn:
             res = conn.query(
-                "INSERT INTO posts (hexid, title, url, text, author, permalink,"
-                " subreddit, comments, ups, downs, score, created, is_self, over_18)"
-                " VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT DO NOTHING RETURNING ID",
+                "insert_post",
                 (post_id, title, url, selftext, author, permalink, subreddit, num_comments,
-                 upvotes, downvotes, score, created_utc, is_self, over_18))
+                 upvotes, downvotes, score, created_utc, is_self, over_18), prepared=True)
         return None if not res else res[0][0]
 
     def get_postid_from_hexid(self, hexid):
         with self.get_conn() as conn:
-            res = conn.query(
-                "SELECT id FROM posts WHERE hexid=%s",
-                (hexid,))
+            res = conn.query("postid_from_hexid", (hexid,), prepared=True)
         return None if not res else res[0]
 
+    def get_commentid_from_hexid(self, hexid):
+        with self.get_conn() as conn:
+            res = conn.query("commentid_from_hexid", (hexid,), prepared=True)
+        return None if not res else res[0][0]
+
     # Search
 
-    def build_result_for_images(self, images):
+    @staticmethod
+    def _ids(items):
+        """ Distinct ids, in order of first appearance """
+        return list(dict.fromkeys((x[0] if isinstance(x, tuple) else x) for x in items))
+
+    @staticmethod
+    def _image_result(row, distances):
+        item = ImageItem(
+            url=row[0],
+            width=row[24],
+            height=row[25],
+            size=row[26],
+            thumb=os.path.join(thumb_path(row[28]), str(row[28]) + ".jpg"),
+            sha1=row[27],
+            album_url=row[1],
+            distance=distances.get(row[28]) if distances else None,
+            image_id=row[28]
+        )
+        if row[3] is not None:
+            return CommentSearchResult(
+                body=row[5],
+                post_id=row[11],
+                hexid=row[3],
+                author=row[4],
+                ups=row[6],
+                downs=row[7],
+                created=row[8],
+                subreddit=row[9],
+                permalink=row[10],
+                item=item
+            )
+        return PostSearchResult(
+            text=row[15],
+            title=row[13],
+            hexid=row[12],
+            author=row[16],
+            ups=row[20],
+            downs=row[21],
+            created=row[23],
+            subreddit=row[18],
+            permalink=row[17],
+            comments=row[19],
+            item=item
+        )
+
+    # Results follow the order of the image ids (then of the image urls)
+    _IMAGE_RESULTS_QUERY = (
+        "WITH DATA AS("
+        " SELECT imu.id AS urlid, url, imageid, bytes, sha1, width, height, albumid, postid, commentid, q.ord "
+        " FROM unnest(%s::int[]) WITH ORDINALITY AS q(id, ord) "
+        " INNER JOIN images im on im.id = q.id "
+        " INNER JOIN imageurls imu on imu.imageid = im.id "
+        ") "
+        "SELECT "
+        "d.url, a.url, c.postid, c.hexid, c.author, c.body, c.ups, "
+        "c.downs, c.created, cp.subreddit, cp.permalink, cp.hexid, "
+        "p.hexid, p.title, p.url, p.text, p.author, p.permalink, p.subreddit, "
+        "p.comments, p.ups, p.downs, p.score, p.created, d.width, d.height, "
+        "d.bytes, d.sha1, imageid "
+        "FROM data d "
+        "LEFT JOIN albums a on d.albumid = a.id "
+        "LEFT JOIN comments c on d.commentid = c.id "
+        "LEFT JOIN posts cp on c.postid = cp.id "
+        "LEFT JOIN posts p on d.postid = p.id "
+        "ORDER BY d.ord, d.urlid"
+    )
+
+    def _cached_rows(self, kind, ids, query, id_column):
+        """
+            Returns the result rows of each id, in the order of ids.
+            Only the ids missing from the result cache are queried. Rows that are cached are read from the
+            primary: the replica can lag behind an invalidation, and stale rows would be kept for the cache TTL
+        """
+        cached = self.result_cache.get_many(kind, ids) if self.result_cache else {}
+        missing = [item_id for item_id in ids if item_id not in cached]
+
+        if missing:
+            with (self.get_conn() if self.result_cache else self.get_read_conn()) as conn:
+                res = conn.query(query, (missing,), read_committed=True)
+
+            fetched = {item_id: [] for item_id in missing}
+            for row in res:
+                fetched[row[id_column]].append(row)
+            if self.result_cache:
+                # Items without rows may not be committed yet
+                self.result_cache.put_many(kind, {item_id: rows for item_id, rows in fetched.items() if rows})
+            cached.update(fetched)
+
+        return [row for item_id in ids for row in cached[item_id]]
+
+    def build_result_for_images(self, images, distances=None):
+        """
+            * images - image ids, or rows whose first column is the image id. Results are in the same order
+            * distances - optional {image id: distance}
+        """
         if not images:
             return []
 
-        results = []
+        rows = self._cached_rows("im", self._ids(images), self._IMAGE_RESULTS_QUERY, 28)
+        return [self._image_result(row, distances) for row in rows]
 
-        with self.get_conn() as conn:
-            # TODO: order by?
-            res = conn.query(
-                "WITH DATA AS("
-                " SELECT url, imageid, bytes, sha1, width, height, albumid, postid, commentid "
-                " FROM imageurls imu, images im WHERE imu.imageid = im.id AND im.id = ANY (%s) "
-                ") "
-                "SELECT "
-                "d.url, a.url, c.postid, c.hexid, c.author, c.body, c.ups, "
-                "c.downs, c.created, cp.subreddit, cp.permalink, cp.hexid, "
-                "p.hexid, p.title, p.url, p.text, p.author, p.permalink, p.subreddit, "
-                "p.comments, p.ups, p.downs, p.score, p.created, d.width, d.height, "
-                "d.bytes, d.sha1, imageid "
-                "FROM data d "
-                "LEFT JOIN albums a on d.albumid = a.id "
-                "LEFT JOIN comments c on d.commentid = c.id "
-                "LEFT JOIN posts cp on c.postid = cp.id "
-                "LEFT JOIN posts p on d.postid = p.id",
-                ([(x[0] if isinstance(x, tuple) else x) for x in images],), read_committed=True,
-            )
-
-            for row in res:
-                if row[3] is not None:
-                    results.append(CommentSearchResult(
-                        body=row[5],
-                        post_id=row[11],
-                        hexid=row[3],
-                        author=row[4],
-                        ups=row[6],
-                        downs=row[7],
-                        created=row[8],
-                        subreddit=row[9],
-                        permalink=row[10],
-                        item=ImageItem(
-                            url=row[0],
-                            width=row[24],
-                            height=row[25],
-                            size=row[26],
-                            thumb=os.path.join(thumb_path(row[28]), str(row[28]) + ".jpg"),
-                            sha1=row[27],
-                            album_url=row[1]
-                        )
-                    ))
-                else:
-                    results.append(PostSearchResult(
-                        text=row[15],
-                        title=row[13],
-                        hexid=row[12],
-                        author=row[16],
-                        ups=row[20],
-                        downs=row[21],
-                        created=row[23],
-                        subreddit=row[18],
-                        permalink=row[17],
-                        comments=row[19],
-                        item=ImageItem(
-                            url=row[0],
-                            width=row[24],
-                            height=row[25],
-                            size=row[26],
-                            thumb=os.path.join(thumb_path(row[28]), str(row[28]) + ".jpg"),
-                            sha1=row[27],
-                            album_url=row[1]
-                        )
-                    ))
-            return results
-
-    def build_results_for_videos(self, videos):
-
-        results = []
+    def iter_result_for_images(self, images, distances=None):
+        """ Same as build_result_for_images(), but yields results as rows arrive from a server-side cursor """
+        if not images:
+            return
 
-        with self.get_conn() as conn:
-            # TODO: order by?
-            res = conn.query(
-                "WITH DATA AS ("
-                " SELECT url, videoid, postid, commentid, width, "
-                " height, bytes, sha1, frames, duration, format, codec, bitrate "
-                " FROM videourls vu, videos vid "
-                " WHERE vu.videoid = vid.id AND vid.id = ANY (%s)"
-                ")"
-                "SELECT d.url, c.postid, c.hexid, c.author, c.body, c.ups, c.downs,"
-                " c.created, cp.subreddit, cp.permalink, cp.hexid, p.hexid, p.title,"
-                " p.url, p.text, p.author, p.permalink, p.subreddit, p.comments, p.ups,"
-                " p.downs, p.score, p.created, d.width, d.height, d.bytes, d.sha1, d.frames,"
-                " d.duration, d.format, d.codec, d.bitrate, d.videoid "
-                "FROM data d "
-                " LEFT JOIN comments c on d.commentid = c.id "
-                " LEFT JOIN posts cp on c.postid = cp.id "
-                " LEFT JOIN posts p on d.postid = p.id",
-                ([(x[0] if isinstance(x, tuple) else x) for x in videos],), read_committed=True,
+        # The named cursor holds its connection for as long as the client reads the results
+        pool, conn = self._getconn_read()
+        try:
+            with conn.cursor(name="image_results") as cur:
+                cur.itersize = 500
+                cur.execute(self._IMAGE_RESULTS_QUERY, (self._ids(images),))
+                for row in cur:
+                    yield self._image_result(row, distances)
+        finally:
+            pool.putconn(conn)
+
+    @staticmethod
+    def _video_result(row, matched_frames):
+        item = VideoItem(
+            url=row[0],
+            width=row[23],
+            height=row[24],
+            size=row[25],
+            sha1=row[26],
+            frames=row[27],
+            duration=row[28],
+            format=row[29],
+            codec=row[30],
+            bitrate=row[31],
+            video_id=row[32],
+            matched_frames=matched_frames.get(row[32]) if matched_frames else None
+        )
+        if row[2] is not None:
+            return CommentSearchResult(
+                body=row[4],
+                post_id=row[10],
+                hexid=row[2],
+                author=row[3],
+                ups=row[5],
+                downs=row[6],
+                created=row[7],
+                subreddit=row[8],
+                permalink=row[9],
+                item=item
             )
+        return PostSearchResult(
+            text=row[14],
+            title=row[12],
+            hexid=row[11],
+            author=row[15],
+            ups=row[19],
+            downs=row[20],
+            created=row[22],
+            subreddit=row[17],
+            permalink=row[16],
+            comments=row[18],
+            item=item
+        )
+
+    # Results follow the order of the video ids (then of the video urls)
+    _VIDEO_RESULTS_QUERY = (
+        "WITH DATA AS ("
+        " SELECT vu.id AS urlid, url, videoid, postid, commentid, width, "
+        " height, bytes, sha1, frames, duration, format, codec, bitrate, q.ord "
+        " FROM unnest(%s::int[]) WITH ORDINALITY AS q(id, ord) "
+        " INNER JOIN videos vid on vid.id = q.id "
+        " INNER JOIN videourls vu on vu.videoid = vid.id"
+        ")"
+        "SELECT d.url, c.postid, c.hexid, c.author, c.body, c.ups, c.downs,"
+        " c.created, cp.subreddit, cp.permalink, cp.hexid, p.hexid, p.title,"
+        " p.url, p.text, p.author, p.permalink, p.subreddit, p.comments, p.ups,"
+        " p.downs, p.score, p.created, d.width, d.height, d.bytes, d.sha1, d.frames,"
+        " d.duration, d.format, d.codec, d.bitrate, d.videoid "
+        "FROM data d "
+        " LEFT JOIN comments c on d.commentid = c.id "
+        " LEFT JOIN posts cp on c.postid = cp.id "
+        " LEFT JOIN posts p on d.postid = p.id "
+        "ORDER BY d.ord, d.urlid"
+    )
+
+    def build_results_for_videos(self, videos, matched_frames=None):
+        """
+            * videos - video ids, or rows whose first column is the video id. Results are in the same order
+            * matched_frames - optional {video id: matched frame count}
+        """
+        if not videos:
+            return []
 
-            for row in res:
-                if row[2] is not None:
-                    results.append(CommentSearchResult(
-                        body=row[4],
-                        post_id=row[10],
-                        hexid=row[2],
-                        author=row[3],
-                        ups=row[5],
-                        downs=row[6],
-                        created=row[7],
-                        subreddit=row[8],
-                        permalink=row[9],
-                        item=VideoItem(
-                            url=row[0],
-                            width=row[23],
-                            height=row[24],
-                            size=row[25],
-                            sha1=row[26],
-                            frames=row[27],
-                            duration=row[28],
-                            format=row[29],
-                            codec=row[30],
-                            bitrate=row[31],
-                            video_id=row[32]
-                        )
-                    ))
-                else:
-                    results.append(PostSearchResult(
-                        text=row[14],
-                        title=row[12],
-                        hexid=row[11],
-                        author=row[15],
-                        ups=row[19],
-                        downs=row[20],
-                        created=row[22],
-                        subreddit=row[17],
-                        permalink=row[16],
-                        comments=row[18],
-                        item=VideoItem(
-                            url=row[0],
-                            width=row[23],
-                            height=row[24],
-                            size=row[25],
-                            sha1=row[26],
-                            frames=row[27],
-                            duration=row[28],
-                            format=row[29],
-                            codec=row[30],
-                            bitrate=row[31],
-                            video_id=row[32]
-                        )
-                    ))
-            return results
+        rows = self._cached_rows("vid", self._ids(videos), self._VIDEO_RESULTS_QUERY, 32)
+        return [self._video_result(row, matched_frames) for row in rows]
 
     def get_images_from_reddit_id(self, reddit_id):
-        with self.get_conn() as conn:
+        with self.get_read_conn() as conn:
             if len(reddit_id) == 6:
                 res = conn.query(
                     "SELECT DISTINCT imageid from imageurls "
@@ -585,26 +956,24 @@ class DB:
                 raise Exception("Invalid reddit id")
         return res
 
-    def get_images_from_author(self, author):
-
-        with self.get_conn() as conn:
-            imageids = []
-            imageids.extend(conn.query(
-                "SELECT imageid "
-                "from imageurls "
-                "INNER JOIN posts p on imageurls.postid = p.id WHERE author = %s",
-                (author,), read_committed=True,
-            ))
-            imageids.extend(conn.query(
-                "SELECT imageid "
-                "from imageurls "
-                "INNER JOIN comments c on imageurls.postid = c.id WHERE author = %s",
-                (author,), read_committed=True,
-            ))
+    def get_images_from_author(self, author, after=0, offset=0, limit=None):
+        """ Returns distinct (imageid,) rows of images posted by author, in imageid order.
+         Pages are selected either with the last imageid of the previous page (after) or an offset """
+        with self.get_read_conn() as conn:
+            imageids = conn.query(
+                "SELECT imageid FROM ("
+                " SELECT imageid from imageurls "
+                " INNER JOIN posts p on imageurls.postid = p.id WHERE author = %s "
+                " UNION "
+                " SELECT imageid from imageurls "
+                " INNER JOIN comments c on imageurls.commentid = c.id WHERE author = %s"
+                ") AS i WHERE imageid > %s ORDER BY imageid OFFSET %s LIMIT %s",
+                (author, author, after, offset, limit), read_committed=True,
+            )
         return imageids
 
     def get_images_from_album_url(self, album_url):
-        with self.get_conn() as conn:
+        with self.get_read_conn() as conn:
             res = conn.query(
                 "SELECT i.id, u.url, i.width, i.height from albums "
                 "INNER JOIN imageurls u on albums.id = u.albumid "
@@ -613,52 +982,42 @@ class DB:
                 , read_committed=True)
         return res
 
-    def get_images_from_text(self, text):
-        with self.get_conn() as conn:
-            text = "%" + text + "%"
+    def get_images_from_text(self, text, offset=0, limit=None):
+        """ Returns (imageid, rank) rows of images of posts and comments matching text, best first.
+         The rank of a post or comment is its text relevance, boosted by its score """
+        with self.get_read_conn() as conn:
             res = conn.query(
-                "SELECT DISTINCT(imageid) FROM imageurls "
-                "WHERE commentid is NULL AND postid IN "
-                "(SELECT id FROM Posts WHERE title LIKE %s or text LIKE %s ORDER BY ups DESC) "
-                "OR commentid IN "
-                "(SELECT id FROM Comments WHERE body LIKE %s ORDER BY ups DESC) "
-                "LIMIT 50",
-                (text, text, text)
+                "SELECT imageid, max(rank) AS rank FROM ("
+                " SELECT u.imageid, ts_rank_cd(p.tsv, q) * (1 + ln(1 + greatest(p.score, 0))) AS rank "
+                " FROM plainto_tsquery('english', %s) q, posts p "
+                " INNER JOIN imageurls u ON u.postid = p.id AND u.commentid IS NULL "
+                " WHERE p.tsv @@ q "
+                " UNION ALL "
+                " SELECT u.imageid, ts_rank_cd(c.tsv, q) * (1 + ln(1 + greatest(c.ups - c.downs, 0))) "
+                " FROM plainto_tsquery('english', %s) q, comments c "
+                " INNER JOIN imageurls u ON u.commentid = c.id "
+                " WHERE c.tsv @@ q "
+                ") AS r GROUP BY imageid ORDER BY rank DESC, imageid OFFSET %s LIMIT %s",
+                (text, text, offset, limit), read_committed=True
             )
         return res
 
     # Stats
-    def get_post_count(self):
-        with self.get_conn() as conn:
-            return conn.query(
-                "SELECT reltuples AS approximate_row_count FROM pg_class WHERE relname = 'posts'",
-                read_committed=True
-            )[0][0]
-
-    def get_image_count(self):
-        with self.get_conn() as conn:
-            return conn.query(
-                "SELECT reltuples AS approximate_row_count FROM pg_class WHERE relname = 'images'",
-                read_committed=True
-            )[0][0]
-
-    def get_videoframe_count(self):
-        with self.get_conn() as conn:
-            return conn.query(
-                "SELECT reltuples AS approximate_row_count FROM pg_class WHERE relname = 'videoframes'",
-                read_committed=True
-            )[0][0]
-
-    def get_comment_count(self):
-        with self.get_conn() as conn:
-            return conn.query(
-                "SELECT reltuples AS approximate_row_count FROM pg_class WHERE relname = 'comments'",
-                read_committed=True
-            )[0][0]
+    _STATS_TABLES = ("posts", "comments", "images", "imageurls", "albums", "videos", "videoframes")
 
-    def get_album_count(self):
+    def get_stats(self):
+        """
+            Returns ({table: approximate row count}, images inserted, posts inserted). Insert counters only
+            count rows actually inserted (unlike ids, which conflicting inserts also consume) and are reset when
+            the server restarts. They are read from the primary: a replica doesn't count replayed rows
+        """
         with self.get_conn() as conn:
-            return conn.query(
-                "SELECT reltuples AS approximate_row_count FROM pg_class WHERE relname = 'albums'",
+            res = conn.query(
+                "SELECT " +
+                ", ".join("(SELECT greatest(reltuples, 0)::bigint FROM pg_class WHERE relname = '%s')" % table
+                          for table in self._STATS_TABLES) +
+                ", (SELECT coalesce(sum(n_tup_ins), 0) FROM pg_stat_user_tables WHERE relname = 'images')"
+                ", (SELECT coalesce(sum(n_tup_ins), 0) FROM pg_stat_user_tables WHERE relname = 'posts')",
                 read_committed=True
-            )[0][0]
+            )[0]
+        return dict(zip(self._STATS_TABLES, res)), res[-2], res[-1]
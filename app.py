@@ -1,7 +1,8 @@
 from flask import Flask
 
-from common import cache
+from common import cache, logger, DBFILE
 from index import index_page
+from migrations import get_version, SCHEMA_VERSION
 from search import search_page
 from status import status_page
 from subreddits import subreddits_page
@@ -17,5 +18,8 @@ app.register_blueprint(search_page)
 app.register_blueprint(upload_page)
 app.register_blueprint(video_thumbs)
 
+if get_version(DBFILE) < SCHEMA_VERSION:
+    logger.warning("Database schema is not up to date, searches may scan whole tables. Run migrations.py")
+
 if __name__ == '__main__':
     app.run(port=3080)
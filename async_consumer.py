@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import binascii
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import aio_pika
+import aiohttp
+import asyncpg
+from PIL import Image
+from youtube_dl import YoutubeDL
+
+from DB import DB, PREPARED_STATEMENTS
+from Httpy import DEFAULT_TIMEOUT
+from common import logger, DBFILE, HTTP_PROXY, IMAGE_INDEX, HASH_MATRIX_PATH, USE_REDIS, DB_POOL_MIN, \
+    DB_POOL_MAX, ASYNC_CONCURRENCY, ASYNC_CPU_THREADS, RABBITMQ_HOST, CONSUMER_QUEUE, CPU_WORKERS
+from cpu_stage import CpuStage
+from hash_index import MmapHashIndex
+from hash_util import hash_chunks, hash_to_int
+from img_util import get_image_urls, save_thumb, get_sha1, thumb_path
+from migrations import get_version, SCHEMA_VERSION
+from rabbitmq_listen import SCHEMA
+from reddit import Post, Comment, COMMENT_FIELDS, POST_FIELDS
+from result_cache import ResultCache
+from util import is_image_direct_link, should_parse_link, is_video, load_list, clean_url
+from video_util import info_from_video_buffer, flatten_video_info
+
+# Media that can't be downloaded or decoded is skipped, the message is still acknowledged. Any other error
+# (e.g. a lost database connection) rejects the message
+DOWNLOAD_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+DECODE_ERRORS = (OSError, SyntaxError, ValueError, Image.DecompressionBombError)
+
+
+def _connect_kwargs(dsn):
+    """ asyncpg only parses URIs, convert "key=value ..." connection strings """
+    if dsn.startswith(("postgres://", "postgresql://")):
+        return {"dsn": dsn}
+    params = dict(token.split("=", 1) for token in dsn.split())
+    if "dbname" in params:
+        params["database"] = params.pop("dbname")
+    return params
+
+
+def _save_video_thumbs(frames, frame_ids):
+    for i, thumb in enumerate(frames.values()):
+        dirpath = thumb_path(frame_ids[i], "vid")
+        os.makedirs(dirpath, exist_ok=True)
+        thumb.save(os.path.join(dirpath, "%d.jpg" % frame_ids[i]))
+
+
+class AsyncConsumer:
+    """
+        Same processing as rabbitmq_listen.Consumer, on an event loop: up to concurrency messages are
+        handled at once, downloads use aiohttp and database calls use asyncpg (which prepares and caches
+        the statements of each connection). Decoding, hashing and thumbnails run in the worker processes
+        of a CpuStage, file writes in a pool of cpu_threads threads and blocking calls (album resolution,
+        youtube-dl, ffmpeg) in the loop's default executor.
+    """
+
+    def __init__(self, concurrency=ASYNC_CONCURRENCY, cpu_threads=ASYNC_CPU_THREADS, host=RABBITMQ_HOST,
+                 queue=CONSUMER_QUEUE, cpu_workers=CPU_WORKERS):
+        # Tables are created synchronously before the loop starts
+        DB(DBFILE, **SCHEMA)
+        # Prepared inserts write columns added by the migrations
+        version = get_version(DBFILE)
+        if version < SCHEMA_VERSION:
+            logger.error("Database schema version is %d, expected %d: run migrations.py first" %
+                         (version, SCHEMA_VERSION))
+            sys.exit(1)
+
+        self.concurrency = concurrency
+        self.host = host
+        self.queue = queue
+        self._cpu = ThreadPoolExecutor(max_workers=cpu_threads)
+        self.cpu = CpuStage(cpu_workers)
+        self._slots = None
+        # Running message tasks, the loop only keeps weak references to them
+        self._tasks = set()
+        self.pg = None
+        self.http = None
+        self.hash_matrix = MmapHashIndex(HASH_MATRIX_PATH) if IMAGE_INDEX == "mmap" else None
+        # Only used to invalidate the search results cached in redis
+        self.result_cache = ResultCache(max_bytes=0) if USE_REDIS else None
+
+    async def _run_cpu(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._cpu, fn, *args)
+
+    @staticmethod
+    async def _run_blocking(fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def run(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self.pg = await asyncpg.create_pool(min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, **_connect_kwargs(DBFILE))
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, ssl=False),
+            timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT),
+        )
+
+        connection = await aio_pika.connect_robust(host=self.host)
+        channel = await connection.channel()
+        # At most concurrency unacknowledged messages: the broker holds the backlog, not this process
+        await channel.set_qos(prefetch_count=self.concurrency)
+        exchange = await channel.declare_exchange("reddit", aio_pika.ExchangeType.TOPIC)
+        if self.queue:
+            queue = await channel.declare_queue(self.queue, durable=True)
+        else:
+            queue = await channel.declare_queue(exclusive=True)
+        for sub in load_list("subs.txt"):
+            await queue.bind(exchange, routing_key="*.%s" % sub)
+
+        logger.info("Consuming with up to %d messages in flight" % self.concurrency)
+        async with queue.iterator() as messages:
+            async for message in messages:
+                await self._slots.acquire()
+                task = asyncio.ensure_future(self._handle(message))
+                self._tasks.add(task)
+                task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def _handle(self, message):
+        """ Acknowledges the message once it is persisted. A message that fails twice is dropped """
+        try:
+            await self._message_callback(message.body)
+            await message.ack()
+        except Exception as e:
+            logger.error(e)
+            await message.reject(requeue=not message.redelivered)
+
+    async def _message_callback(self, body):
+        j = json.loads(body)
+        for item in j:
+            item["urls"] = item["_urls"]
+
+            if "title" in item:
+                await self.parse_post(Post(*(item[k] for k in POST_FIELDS)))
+            else:
+                await self.parse_comment(Comment(*(item[k] for k in COMMENT_FIELDS)))
+
+    async def download(self, url):
+        async with self.http.get(url, proxy=HTTP_PROXY) as r:
+            body = await r.read()
+            if r.status != 200:
+                raise aiohttp.ClientError("HTTP%d %s" % (r.status, url))
+            return body
+
+    def _invalidate_results(self, kind, item_id):
+        if self.result_cache is not None:
+            self.result_cache.invalidate(kind, item_id)
+
+    async def parse_post(self, post):
+        postid_db = await self.pg.fetchval(
+            PREPARED_STATEMENTS["insert_post"],
+            post.id, post.title, post.url, post.selftext, post.author, post.permalink, post.subreddit,
+            post.num_comments, post.ups, post.downs, post.score, int(post.created_utc), post.is_self, post.over_18)
+
+        if postid_db is None:
+            # Already indexed, possibly by a delivery of this message that did not finish: urls that were
+            # already parsed are found by image_from_url
+            postid_db = await self.pg.fetchval(PREPARED_STATEMENTS["postid_from_hexid"], post.id)
+            if postid_db is None:
+                return False
+
+        await asyncio.gather(*(self.parse_url(url, postid=postid_db) for url in post.urls))
+
+    async def parse_comment(self, comment):
+
+        if comment.urls:
+            postid = await self.pg.fetchval(PREPARED_STATEMENTS["postid_from_hexid"], comment.link_id[3:])
+            if not postid:
+                return
+            try:
+                comid_db = await self.pg.fetchval(
+                    PREPARED_STATEMENTS["insert_comment"],
+                    postid, comment.id, comment.author, comment.body, comment.ups, comment.downs,
+                    int(comment.created_utc))
+            except asyncpg.UniqueViolationError:
+                comid_db = await self.pg.fetchval(PREPARED_STATEMENTS["commentid_from_hexid"], comment.id)
+            await asyncio.gather(*(self.parse_url(url, postid=postid, commentid=comid_db) for url in comment.urls))
+
+    async def parse_url(self, url, postid=None, commentid=None):
+        """
+            Gets image hash(es) from URL, populates database. Only download, resolution and decoding errors
+            are logged and skipped, database errors propagate so that the message is not acknowledged
+        """
+        if is_image_direct_link(url):
+            await self.parse_image(url, postid=postid, commentid=commentid, albumid=None)
+            return True
+
+        if is_video(url):
+            await self.parse_video(url, postid=postid, commentid=commentid)
+            return True
+
+        if "v.redd.it" in url:
+            logger.debug("Using youtube-dl to get reddit video url")
+            try:
+                info = await self._run_blocking(
+                    lambda: YoutubeDL().extract_info(url, download=False, process=False))
+                best = max(info["formats"], key=lambda x: x["width"] if "width" in x and x["width"] else 0)
+            except Exception as e:
+                logger.error(e)
+                return
+            await self.parse_video(best["url"], postid=postid, commentid=commentid)
+            return
+
+        if not should_parse_link(url):
+            return
+
+        # Scrapers and youtube-dl do not use the database
+        try:
+            image_urls = await self._run_blocking(get_image_urls, url)
+        except Exception as e:
+            logger.error(e)
+            return
+
+        # We assume that any url that yields more than 1 image is an album
+        albumid = None
+        if len(image_urls) > 1:
+            albumid = await self.get_or_create_album(url)
+
+        tasks = []
+        for image_url in image_urls:
+            if is_image_direct_link(image_url):
+                tasks.append(self.parse_image(image_url, postid=postid, commentid=commentid, albumid=albumid))
+            elif is_video(image_url):
+                tasks.append(self.parse_video(image_url, postid=postid, commentid=commentid))
+        await asyncio.gather(*tasks)
+        return True
+
+    async def get_or_create_album(self, url):
+        albumid = await self.pg.fetchval("INSERT INTO albums (url) VALUES ($1) ON CONFLICT DO NOTHING RETURNING id", url)
+        if albumid is None:
+            albumid = await self.pg.fetchval("SELECT id FROM albums WHERE url = $1", url)
+        return albumid
+
+    async def insert_imageurl(self, url, imageid, albumid, postid, commentid):
+        await self.pg.execute(PREPARED_STATEMENTS["insert_imageurl"],
+                              url, clean_url(url), imageid, albumid, postid, commentid)
+
+    async def insert_image(self, imhash, width, height, size, sha1):
+        async with self.pg.acquire() as conn:
+            async with conn.transaction():
+                imageid = await conn.fetchval(PREPARED_STATEMENTS["insert_image"], width, height, size, imhash, sha1)
+                # race condition: image was inserted after the existing_by_sha1 check
+                if imageid is None:
+                    return await conn.fetchval(PREPARED_STATEMENTS["image_from_sha1"], sha1)
+                await conn.execute(PREPARED_STATEMENTS["insert_image_hash_chunks"],
+                                   imageid, *hash_chunks(hash_to_int(imhash)))
+        return imageid
+
+    async def parse_image(self, url, postid=None, commentid=None, albumid=None):
+        existing_by_url = await self.pg.fetchval(PREPARED_STATEMENTS["image_from_url"], clean_url(url))
+        if existing_by_url:
+            await self.insert_imageurl(url, existing_by_url, albumid, postid, commentid)
+            self._invalidate_results("im", existing_by_url)
+            return
+
+        try:
+            image_buffer = await self.download(url)
+        except DOWNLOAD_ERRORS as e:
+            logger.error(e)
+            return
+
+        sha1 = get_sha1(image_buffer)
+        existing_by_sha1 = await self.pg.fetchval(PREPARED_STATEMENTS["image_from_sha1"], sha1)
+        if existing_by_sha1:
+            await self.insert_imageurl(url, existing_by_sha1, albumid, postid, commentid)
+            self._invalidate_results("im", existing_by_sha1)
+            return
+
+        try:
+            info = await asyncio.wrap_future(self.cpu.submit(image_buffer))
+        except DECODE_ERRORS as e:
+            logger.error("Could not decode %s: %s" % (url, e))
+            return
+        imhash, width, height = info.hash, info.width, info.height
+        size = len(image_buffer)
+
+        imageid = await self.insert_image(imhash, width, height, size, sha1)
+        await self.insert_imageurl(url, imageid, albumid, postid, commentid)
+        if self.hash_matrix is not None:
+            await self._run_cpu(self.hash_matrix.append, imageid, imhash)
+        await self._run_cpu(save_thumb, info.thumbnail, imageid)
+
+        logger.info("(+) Image ID(%s) [%dx%s %dB] #%s" %
+                    (
+                        imageid, width, height, size,
+                        binascii.hexlify(imhash).decode("ascii")
+                    ))
+
+    async def insert_videourl(self, url, video_id, postid, commentid):
+        await self.pg.execute(PREPARED_STATEMENTS["insert_videourl"], url, clean_url(url), video_id, postid, commentid)
+
+    async def parse_video(self, url, postid=None, commentid=None):
+        existing_by_url = await self.pg.fetchval(PREPARED_STATEMENTS["video_from_url"], clean_url(url))
+        if existing_by_url:
+            await self.insert_videourl(url, existing_by_url, postid, commentid)
+            self._invalidate_results("vid", existing_by_url)
+            return
+
+        try:
+            video_buffer = await self.download(url)
+        except DOWNLOAD_ERRORS as e:
+            logger.error(e)
+            return
+        if not video_buffer:
+            logger.error("Download failed %s" % url)
+            return
+
+        sha1 = get_sha1(video_buffer)
+        existing_by_sha1 = await self.pg.fetchval(PREPARED_STATEMENTS["video_from_sha1"], sha1)
+        if existing_by_sha1:
+            await self.insert_videourl(url, existing_by_sha1, postid, commentid)
+            self._invalidate_results("vid", existing_by_sha1)
+            return
+
+        try:
+            frames, info = await self._run_blocking(
+                info_from_video_buffer, video_buffer, url[url.rfind(".") + 1:].replace("gifv", "mp4"))
+        except Exception as e:
+            logger.error("Could not decode %s: %s" % (url, e))
+            return
+        if not frames:
+            logger.error("No frames " + url)
+            return
+
+        info = flatten_video_info(info)
+
+        async with self.pg.acquire() as conn:
+            video_id = await conn.fetchval(
+                "INSERT INTO videos (sha1, width, height, bitrate, codec, format, duration, frames, bytes) "
+                "VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9) ON CONFLICT DO NOTHING RETURNING id",
+                sha1, info["width"], info["height"], info["bitrate"], info["codec"], info["format"],
+                info["duration"], info["frames"], len(video_buffer))
+            # race condition: video was inserted after the existing_by_sha1 check
+            if video_id is None:
+                video_id = await conn.fetchval(PREPARED_STATEMENTS["video_from_sha1"], sha1)
+            await conn.execute(PREPARED_STATEMENTS["insert_videourl"], url, clean_url(url), video_id, postid, commentid)
+
+            rows = await conn.fetch("INSERT INTO videoframes (hash, videoid) "
+                                    "SELECT unnest($1::bytea[]), $2 RETURNING id", list(frames), video_id)
+            frame_ids = [row[0] for row in rows]
+
+        await self._run_cpu(_save_video_thumbs, frames, frame_ids)
+
+        logger.info("(+) Video ID(%s) [%dx%s %dB] %d frames" %
+                    (video_id, info["width"], info["height"],
+                     len(video_buffer), len(frames)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=RABBITMQ_HOST, help="RabbitMQ host")
+    parser.add_argument("--queue", default=CONSUMER_QUEUE,
+                        help="Shared durable queue, consumers using the same name split the work")
+    parser.add_argument("--concurrency", type=int, default=ASYNC_CONCURRENCY, help="Messages processed at once")
+    parser.add_argument("--cpu-threads", type=int, default=ASYNC_CPU_THREADS, help="Thumbnail writer threads")
+    parser.add_argument("--cpu-workers", type=int, default=CPU_WORKERS, help="Image processing processes")
+    args = parser.parse_args()
+
+    try:
+        consumer = AsyncConsumer(args.concurrency, args.cpu_threads, args.host, args.queue, args.cpu_workers)
+        asyncio.get_event_loop().run_until_complete(consumer.run())
+    except KeyboardInterrupt:
+        logger.error('Interrupted (^C)')
@@ -0,0 +1,93 @@
+from multiprocessing import Pool
+
+from psycopg2.extras import execute_values
+
+from common import logger
+
+CHUNK_SIZE = 10000
+
+
+def update_columns(table, columns, template=None):
+    """
+        Returns a write function for run() that sets columns of table from (id, *values) rows with
+        a single UPDATE ... FROM (VALUES ...) per chunk
+        * template - execute_values row template, to cast values whose type can't be inferred, e.g. "(%s, %s::bytea)"
+    """
+    query = "UPDATE %s AS t SET %s FROM (VALUES %%s) AS v(id, %s) WHERE t.id = v.id" % (
+        table, ", ".join("%s = v.%s" % (c, c) for c in columns), ", ".join(columns))
+
+    def write(cur, rows):
+        execute_values(cur, query, rows, template=template, page_size=len(rows))
+
+    return write
+
+
+def _create_checkpoint_table(db):
+    with db.get_conn() as conn:
+        conn.exec("CREATE TABLE IF NOT EXISTS backfill_checkpoint ("
+                  "name TEXT PRIMARY KEY, last_id INTEGER NOT NULL, updated TIMESTAMP NOT NULL DEFAULT now())")
+
+
+def get_checkpoint(db, name):
+    _create_checkpoint_table(db)
+    with db.get_conn() as conn:
+        res = conn.query("SELECT last_id FROM backfill_checkpoint WHERE name=%s", (name,))
+    return 0 if not res else res[0][0]
+
+
+def run(db, name, table, columns, write, transform=None, chunk_size=CHUNK_SIZE, workers=0, where=None):
+    """
+        Reads (id, *columns) rows of table in id order, in keyset-paginated chunks, and passes
+        [(id, *transform(row))] to write(cursor, rows) for every chunk. Each chunk is read, written and
+        checkpointed in its own transaction, so that an interrupted backfill resumes after the last
+        chunk written (under the name of the backfill) and no transaction outlives a chunk.
+        * transform - function of a (id, *columns) row to a tuple of new values, or None to skip the row.
+            Runs in a pool of workers processes (it must be picklable) when workers > 0
+        * where - extra SQL condition on the rows to read
+    """
+    last_id = get_checkpoint(db, name)
+    if last_id:
+        logger.info("Resuming backfill %s after id %d" % (name, last_id))
+
+    query = "SELECT id%s FROM %s WHERE id > %%s%s ORDER BY id LIMIT %%s" % (
+        "".join(", " + c for c in columns), table, " AND (%s)" % where if where else "")
+
+    pool = Pool(workers) if workers > 0 else None
+    total = 0
+    try:
+        while True:
+            with db.get_conn() as conn:
+                conn.cur.execute(query, (last_id, chunk_size))
+                rows = conn.cur.fetchall()
+                if not rows:
+                    break
+
+                if transform is not None:
+                    values = pool.map(transform, rows, chunksize=max(1, len(rows) // (workers * 4))) \
+                        if pool else [transform(row) for row in rows]
+                    updates = [(row[0], *value) for row, value in zip(rows, values) if value is not None]
+                else:
+                    updates = rows
+
+                if updates:
+                    write(conn.cur, updates)
+                last_id = rows[-1][0]
+                conn.cur.execute("INSERT INTO backfill_checkpoint (name, last_id) VALUES (%s, %s) "
+                                 "ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id, updated = now()",
+                                 (name, last_id))
+                conn.conn.commit()
+
+            total += len(updates)
+            logger.info("Backfill %s: %d rows written, last id %d" % (name, total, last_id))
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return total
+
+
+def reset(db, name):
+    """ Forgets the progress of a backfill, so that it starts over """
+    _create_checkpoint_table(db)
+    with db.get_conn() as conn:
+        conn.exec("DELETE FROM backfill_checkpoint WHERE name=%s", (name,))
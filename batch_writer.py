@@ -0,0 +1,200 @@
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from DB import POST_TSV, COMMENT_TSV
+from common import logger, WRITE_BATCH_SIZE
+from hash_util import hash_chunks, hash_to_int
+from util import clean_url
+
+# Tables in the order they are written, and the DB method used when a batch has to be written row by row
+_TABLES = (
+    ("posts", "insert_post"),
+    ("comments", "insert_comment"),
+    ("images", "insert_image"),
+    ("imageurls", "insert_imageurl"),
+)
+
+
+def _first_only(keys, ids):
+    """ ids[key] for the first occurrence of each key, None for the others (and for keys not in ids) """
+    return [ids.pop(key, None) for key in keys]
+
+
+class BatchWriter:
+    """
+        Write-behind layer over DB for the ingest hot path.
+        insert_post, insert_comment, insert_image and insert_imageurl calls are written with multi-row
+        inserts, up to batch_size rows per transaction. The writer never waits for a batch to fill: rows
+        submitted while a batch is being written make up the next one (group commit), so batches grow with
+        the load and a lone call only pays for its own round trip. Calls block until their batch is committed
+        and return the same values as the DB methods (ids of inserted rows are known before they are used
+        as foreign keys), so concurrent workers share round trips and commits.
+        Every other attribute is the wrapped DB's.
+    """
+
+    def __init__(self, db, batch_size=WRITE_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self._pending = self._empty_batch()
+        self._count = 0
+        self._cond = Condition()
+        Thread(target=self._run, daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    @staticmethod
+    def _empty_batch():
+        return {table: [] for table, _ in _TABLES}
+
+    def insert_post(self, post_id, title, url, selftext,
+                    author, permalink, subreddit, num_comments,
+                    upvotes, downvotes, score,
+                    created_utc, is_self, over_18):
+        return self._submit("posts", (post_id, title, url, selftext, author, permalink, subreddit, num_comments,
+                                      upvotes, downvotes, score, created_utc, is_self, over_18))
+
+    def insert_comment(self, postid, comment_id, comment_author,
+                       comment_body, comment_upvotes, comment_downvotes, comment_created_utc):
+        return self._submit("comments", (postid, comment_id, comment_author, comment_body, comment_upvotes,
+                                         comment_downvotes, comment_created_utc))
+
+    def insert_image(self, imhash, width, height, size, sha1):
+        return self._submit("images", (imhash, width, height, size, sha1))
+
+    def insert_imageurl(self, url, imageid, albumid, postid, commentid):
+        return self._submit("imageurls", (url, imageid, albumid, postid, commentid))
+
+    def _submit(self, table, args):
+        future = Future()
+        with self._cond:
+            self._pending[table].append((args, future))
+            self._count += 1
+            self._cond.notify()
+        return future.result()
+
+    def _take(self):
+        """ Removes up to batch_size of the pending rows, oldest first in each table """
+        batch = self._empty_batch()
+        budget = self.batch_size
+        for table, _ in _TABLES:
+            rows = self._pending[table]
+            batch[table], self._pending[table] = rows[:budget], rows[budget:]
+            budget -= len(batch[table])
+        self._count -= self.batch_size - budget
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._count == 0:
+                    self._cond.wait()
+                batch = self._take()
+
+            try:
+                self._flush(batch)
+            except Exception as e:
+                logger.error("Batch write failed: %s" % (e, ))
+                for rows in batch.values():
+                    for _, future in rows:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def _flush(self, batch):
+        try:
+            with self.db.get_conn() as conn:
+                results = self._write(conn.cur, batch)
+                conn.conn.commit()
+        except Exception as e:
+            # Don't fail the whole batch because of one row
+            logger.warning("Batch write failed, writing %d rows one by one: %s" %
+                           (sum(len(rows) for rows in batch.values()), e))
+            self._write_rows(batch)
+            return
+
+        for table, _ in _TABLES:
+            for (_, future), result in zip(batch[table], results[table]):
+                future.set_result(result)
+
+    def _write_rows(self, batch):
+        for table, method in _TABLES:
+            for args, future in batch[table]:
+                try:
+                    future.set_result(getattr(self.db, method)(*args))
+                except Exception as e:
+                    future.set_exception(e)
+
+    @staticmethod
+    def _write(cur, batch):
+        """ Returns {table: results in the order of the batch rows} """
+        results = {}
+
+        rows = [args for args, _ in batch["posts"]]
+        ids = {}
+        if rows:
+            ids = dict(execute_values(
+                cur,
+                "INSERT INTO posts (hexid, title, url, text, author, permalink,"
+                " subreddit, comments, ups, downs, score, created, is_self, over_18, tsv)"
+                " VALUES %s ON CONFLICT DO NOTHING RETURNING hexid, id",
+                [args + (args[1], args[3]) for args in rows],
+                template="(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s," + POST_TSV + ")",
+                page_size=len(rows), fetch=True
+            ))
+        results["posts"] = _first_only([args[0] for args in rows], ids)
+
+        rows = [args for args, _ in batch["comments"]]
+        ids = {}
+        if rows:
+            ids = dict(execute_values(
+                cur,
+                "INSERT INTO comments (postid, hexid, author, body, ups, downs, created, tsv)"
+                " VALUES %s ON CONFLICT DO NOTHING RETURNING hexid, id",
+                [args + (args[3],) for args in rows],
+                template="(%s,%s,%s,%s,%s,%s,%s," + COMMENT_TSV + ")",
+                page_size=len(rows), fetch=True
+            ))
+        results["comments"] = _first_only([args[1] for args in rows], ids)
+
+        rows = [args for args, _ in batch["images"]]
+        ids = {}
+        if rows:
+            ids = dict(execute_values(
+                cur,
+                "INSERT INTO images (width, height, bytes, hash, sha1) "
+                "VALUES %s ON CONFLICT DO NOTHING RETURNING sha1, id",
+                [(width, height, size, imhash, sha1) for imhash, width, height, size, sha1 in rows],
+                page_size=len(rows), fetch=True
+            ))
+            inserted = {sha1: imhash for imhash, _, _, _, sha1 in rows if sha1 in ids}
+            if inserted:
+                execute_values(
+                    cur,
+                    "INSERT INTO imagehashchunks (imageid, chunk, value) VALUES %s ON CONFLICT DO NOTHING",
+                    [(ids[sha1], i, value) for sha1, imhash in inserted.items()
+                     for i, value in enumerate(hash_chunks(hash_to_int(imhash)))],
+                    page_size=10000
+                )
+
+            # Images inserted by someone else since the existing_by_sha1 check
+            missing = list({args[4] for args in rows} - ids.keys())
+            if missing:
+                cur.execute("SELECT sha1, id FROM images WHERE sha1 = ANY(%s)", (missing,))
+                ids.update(cur.fetchall())
+        results["images"] = [ids.get(args[4]) for args in rows]
+
+        rows = [args for args, _ in batch["imageurls"]]
+        if rows:
+            execute_values(
+                cur,
+                "INSERT INTO imageurls (url, clean_url, imageid, albumid, postid, commentid) VALUES %s",
+                [(url, clean_url(url), imageid, albumid, postid, commentid)
+                 for url, imageid, albumid, postid, commentid in rows],
+                page_size=len(rows)
+            )
+        results["imageurls"] = [None] * len(rows)
+
+        return results
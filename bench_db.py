@@ -0,0 +1,121 @@
+
+# Ingest hot path statement benchmark: per call latency of the PREPARED_STATEMENTS, executed by name
+# vs sent as plain SQL (parsed and planned on every call).
+# Loads synthetic rows in an empty scratch database. Results are printed as JSON.
+#
+# usage: python bench_db.py --dsn "dbname=ir_bench ..." [--rows 100000] [--calls 10000] [--out results.json]
+
+import argparse
+import json
+import os
+import re
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from DB import DB, PREPARED_STATEMENTS
+from rabbitmq_listen import SCHEMA
+
+# (statement, function of (i, id of a loaded image) -> args). Rows i < --rows exist, the others are
+# inserted by the benchmark
+STATEMENTS = (
+    ("image_from_url", lambda i, image_id: ("bench.example/%d.jpg" % i,)),
+    ("image_from_sha1", lambda i, image_id: ("bench%d" % i,)),
+    ("postid_from_hexid", lambda i, image_id: ("b%d" % i,)),
+    ("insert_image", lambda i, image_id: (1, 1, 1, os.urandom(18), "bench%d" % i)),
+    ("insert_imageurl", lambda i, image_id: ("bench.example/%d.jpg" % i, "bench.example/%d.jpg" % i,
+                                             image_id, None, None, None)),
+)
+
+
+def plain_sql(name):
+    """ The statement with psycopg2 placeholders. Only valid when every $n appears once, in order """
+    return re.sub(r"\$\d+", "%s", PREPARED_STATEMENTS[name])
+
+
+def load(db, rows):
+    """ Returns the id of a loaded image """
+    with db.get_conn() as conn:
+        if conn.query("SELECT EXISTS(SELECT 1 FROM images) OR EXISTS(SELECT 1 FROM posts)")[0][0]:
+            print("Refusing to load synthetic data into a non-empty database", file=sys.stderr)
+            sys.exit(1)
+
+    for i in range(rows):
+        postid = db.insert_post("b%d" % i, "title", None, "", "author", "", "sub", 0, 0, 0, 0, 0, False, False)
+        imageid = db.insert_image(os.urandom(18), 1, 1, 1, "bench%d" % i)
+        db.insert_imageurl("bench.example/%d.jpg" % i, imageid, None, postid, None)
+
+    with db.get_conn() as conn:
+        conn.exec("ANALYZE")
+    return imageid
+
+
+def measure(db, name, make_args, ids, prepared, image_id):
+    """ Returns latencies in ms. Every call checks out a connection, as the DB methods do """
+    query = name if prepared else plain_sql(name)
+    returns_rows = "SELECT" in PREPARED_STATEMENTS[name] or "RETURNING" in PREPARED_STATEMENTS[name]
+    latencies = []
+    for i in ids:
+        args = make_args(i, image_id)
+        start = perf_counter()
+        with db.get_conn() as conn:
+            if returns_rows:
+                conn.query(query, args, prepared=prepared)
+            else:
+                conn.exec(query, args, prepared=prepared)
+        latencies.append((perf_counter() - start) * 1000)
+    return latencies
+
+
+def run(args):
+    db = DB(args.dsn, **SCHEMA)
+    image_id = load(db, args.rows)
+
+    rng = np.random.RandomState(args.seed)
+    results = []
+    next_id = args.rows
+    for name, make_args in STATEMENTS:
+        for prepared in (False, True):
+            if name.startswith("insert_"):
+                ids = range(next_id, next_id + args.calls)
+                next_id += args.calls
+            else:
+                ids = rng.randint(0, args.rows, args.calls).tolist()
+
+            latencies = measure(db, name, make_args, ids, prepared, image_id)
+            results.append({
+                "statement": name,
+                "prepared": prepared,
+                "mean_ms": float(np.mean(latencies)),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+            })
+
+    return {
+        "config": vars(args),
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", required=True, help="Empty scratch database")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of posts/images/image urls to load")
+    parser.add_argument("--calls", type=int, default=10000, help="Calls per statement and mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Write results to this file instead of stdout")
+    args = parser.parse_args()
+    if args.rows < 1:
+        parser.error("--rows must be at least 1")
+
+    report = run(args)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+
+# Micro-benchmark for img_util.get_hash / get_hashes
+# Checks that the packed-bits implementation is byte-for-byte identical to the hashes
+# stored by the original implementation, then compares their speed.
+#
+# usage: python bench_hash.py [image files...]
+
+import sys
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+from imagehash import dhash
+
+from img_util import get_hash, get_hashes, HASH_SIZE
+
+
+def legacy_get_hash(im):
+    """ img_util.get_hash() as it was when the stored hashes were computed """
+    return sum(1 << i for i, b in enumerate(dhash(im, hash_size=HASH_SIZE).hash.flatten()) if b) \
+        .to_bytes(18, "big")
+
+
+def random_images(count, seed=0):
+    rng = np.random.RandomState(seed)
+    images = []
+    for i in range(count):
+        w, h = rng.randint(16, 800, size=2)
+        if i % 3 == 0:
+            # Smooth gradients produce many equal neighbouring pixels
+            pixels = np.add.outer(np.arange(h), np.arange(w)).astype(np.uint8)
+            images.append(Image.fromarray(pixels, "L"))
+        elif i % 3 == 1:
+            images.append(Image.fromarray(rng.randint(0, 256, size=(h, w, 3), dtype=np.uint8), "RGB"))
+        else:
+            images.append(Image.fromarray(rng.randint(0, 256, size=(h, w, 4), dtype=np.uint8), "RGBA"))
+    return images
+
+
+def bench(name, fn, count):
+    start = perf_counter()
+    fn()
+    elapsed = perf_counter() - start
+    print("%-24s %8.2f ms total %8.1f us/image" % (name, elapsed * 1000, elapsed / count * 1e6))
+
+
+def main(files):
+    images = [Image.open(f) for f in files] if files else random_images(1000)
+
+    legacy = [legacy_get_hash(im) for im in images]
+    single = [get_hash(im) for im in images]
+    batch = get_hashes(images)
+
+    mismatches = sum(1 for a, b, c in zip(legacy, single, batch) if not a == b == c)
+    print("%d images, %d mismatches" % (len(images), mismatches))
+    if mismatches:
+        sys.exit(1)
+
+    # Hashing only, on already resized grayscale pixels
+    pixels = np.stack([np.asarray(im.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.ANTIALIAS))
+                       for im in images])
+
+    bench("legacy get_hash", lambda: [legacy_get_hash(im) for im in images], len(images))
+    bench("get_hash", lambda: [get_hash(im) for im in images], len(images))
+    bench("get_hashes", lambda: get_hashes(images), len(images))
+    bench("get_hashes (pixels)", lambda: get_hashes(pixels), len(images))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,249 @@
+
+# Similarity search benchmark on synthetic hash corpora
+#
+# Generates random 144-bit hashes with planted near-duplicates of every query, then measures
+# latency percentiles and recall (against a brute-force scan) of each search backend.
+# Results are printed as JSON so that runs of different versions can be compared.
+#
+# usage: python bench_search.py --size 1000000 --backends bktree,mmap,video_index [--out results.json]
+#        python bench_search.py --backends postgres --dsn "dbname=ir_bench ..."  (empty scratch database)
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from hash_index import BKTree, MmapHashIndex, VideoFrameIndex
+from hash_util import HASH_BYTES, HASH_BITS
+
+BACKENDS = ("bktree", "mmap", "video_index", "postgres")
+_SCAN_BLOCK = 1 << 20
+
+
+def parse_range(text):
+    """ "0-30" or "0,5,10" -> list of ints """
+    if "-" in text:
+        low, high = text.split("-")
+        return list(range(int(low), int(high) + 1))
+    return [int(x) for x in text.split(",")]
+
+
+def flip_bits(rng, h, count):
+    bits = np.unpackbits(h)
+    bits[rng.choice(HASH_BITS, count, replace=False)] ^= 1
+    return np.packbits(bits)
+
+
+def make_image_corpus(rng, size, queries, max_distance):
+    """ Returns (hashes, query hashes). Every query has a planted copy at each distance 0..max_distance """
+    hashes = rng.randint(0, 256, size=(size, HASH_BYTES), dtype=np.uint8)
+    query_hashes = rng.randint(0, 256, size=(queries, HASH_BYTES), dtype=np.uint8)
+
+    planted = rng.choice(size, min(size, queries * (max_distance + 1)), replace=False)
+    for i, row in enumerate(planted):
+        hashes[row] = flip_bits(rng, query_hashes[i % queries], i // queries)
+    return hashes, query_hashes
+
+
+def make_video_corpus(rng, videos, frames, queries, max_distance):
+    """ Returns (frame hashes, frame video ids, query frame hash lists).
+     Each query is a copy of a video with every frame moved by up to max_distance bits """
+    hashes = rng.randint(0, 256, size=(videos * frames, HASH_BYTES), dtype=np.uint8)
+    video_ids = np.repeat(np.arange(1, videos + 1), frames)
+
+    query_frames = []
+    for video in rng.choice(videos, queries, replace=False):
+        source = hashes[video * frames:(video + 1) * frames]
+        query_frames.append([flip_bits(rng, h, rng.randint(0, max_distance + 1)) for h in source])
+    return hashes, video_ids, query_frames
+
+
+def brute_force_distances(hashes, query):
+    result = np.empty(len(hashes), dtype=np.uint16)
+    for start in range(0, len(hashes), _SCAN_BLOCK):
+        block = np.bitwise_xor(hashes[start:start + _SCAN_BLOCK], query)
+        result[start:start + _SCAN_BLOCK] = np.unpackbits(block, axis=1).sum(axis=1)
+    return result
+
+
+def brute_force_frame_distances(hashes, query_frames):
+    """ Distance of every frame hash to the closest of the query frames """
+    return np.minimum.reduce([brute_force_distances(hashes, q) for q in query_frames])
+
+
+def brute_force_videos(video_ids, frame_distances, distance, frame_count):
+    votes = np.bincount(video_ids[frame_distances <= distance], minlength=video_ids.max() + 1)
+    return set(np.nonzero(votes >= frame_count)[0].tolist())
+
+
+def measure(fn, queries):
+    """ Returns (latencies in ms, results) """
+    latencies = []
+    results = []
+    for q in queries:
+        start = perf_counter()
+        results.append(fn(q))
+        latencies.append((perf_counter() - start) * 1000)
+    return latencies, results
+
+
+def summarize(latencies, recalls):
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(np.max(latencies)),
+        "recall": float(np.mean(recalls)),
+    }
+
+
+def video_recall(expected, got):
+    return 1.0 if not expected else len(expected & set(got)) / len(expected)
+
+
+def load_postgres(dsn, hashes, frame_hashes, frame_video_ids):
+    """ Loads the corpus in an empty database, image and video ids start at 1 """
+    from psycopg2.extras import execute_values
+    from DB import DB
+    from hash_util import hash_chunks, hash_to_int
+    from rabbitmq_listen import SCHEMA
+
+    db = DB(dsn, **SCHEMA)
+    with db.get_conn() as conn:
+        if conn.query("SELECT EXISTS(SELECT 1 FROM images) OR EXISTS(SELECT 1 FROM videos)")[0][0]:
+            print("Refusing to load synthetic data into a non-empty database", file=sys.stderr)
+            sys.exit(1)
+
+        for start in range(0, len(hashes), 10000):
+            block = [(image_id, h.tobytes()) for image_id, h in
+                     enumerate(hashes[start:start + 10000], start=start + 1)]
+            execute_values(conn.cur, "INSERT INTO images (id, hash, sha1) VALUES %s",
+                           [(image_id, h, "bench%d" % image_id) for image_id, h in block])
+            execute_values(conn.cur, "INSERT INTO imagehashchunks (imageid, chunk, value) VALUES %s",
+                           [(image_id, i, value) for image_id, h in block
+                            for i, value in enumerate(hash_chunks(hash_to_int(h)))])
+
+        execute_values(conn.cur, "INSERT INTO videos (id, sha1) VALUES %s",
+                       [(video_id, "bench%d" % video_id) for video_id in range(1, frame_video_ids.max() + 1)])
+        execute_values(conn.cur, "INSERT INTO videoframes (hash, videoid) VALUES %s",
+                       [(h.tobytes(), int(v)) for h, v in zip(frame_hashes, frame_video_ids)], page_size=10000)
+        conn.exec("ANALYZE")
+    return db
+
+
+def top_k_recall(distances, distance, k, hits):
+    """ Fraction of the expected hits found. When more than k items are within distance,
+     any item at most as far as the k-th closest one is a correct hit """
+    within = np.sort(distances[distances <= distance])
+    if len(within) == 0:
+        return 1.0
+    if len(within) <= k:
+        return sum(1 for image_id, _ in hits if distances[image_id - 1] <= distance) / len(within)
+    return sum(1 for image_id, _ in hits if distances[image_id - 1] <= within[k - 1]) / k
+
+
+def run(args):
+    rng = np.random.RandomState(args.seed)
+    distances = parse_range(args.distances)
+    frame_counts = parse_range(args.frame_counts)
+    max_distance = max(distances)
+
+    hashes, query_hashes = make_image_corpus(rng, args.size, args.queries, max_distance)
+    frame_hashes, frame_video_ids, query_frames = make_video_corpus(
+        rng, args.videos, args.frames, args.queries, max_distance)
+    ids = np.arange(1, len(hashes) + 1)
+
+    image_backends = {}
+    video_backends = {}
+    build_times = {}
+    tmp = tempfile.TemporaryDirectory()
+
+    for backend in args.backends:
+        start = perf_counter()
+        if backend == "bktree":
+            index = BKTree()
+            for item_id, h in zip(ids.tolist(), hashes):
+                index.add(h.tobytes(), item_id)
+            image_backends[backend] = index.nearest
+        elif backend == "mmap":
+            index = MmapHashIndex(os.path.join(tmp.name, "images"))
+            for s in range(0, len(hashes), _SCAN_BLOCK):
+                index.extend(ids[s:s + _SCAN_BLOCK], hashes[s:s + _SCAN_BLOCK])
+            image_backends[backend] = index.nearest
+        elif backend == "video_index":
+            index = VideoFrameIndex()
+            for video_id, h in zip(frame_video_ids.tolist(), frame_hashes):
+                index.add(h.tobytes(), video_id)
+            video_backends[backend] = index.search
+        elif backend == "postgres":
+            if not args.dsn:
+                print("--dsn is required for the postgres backend", file=sys.stderr)
+                sys.exit(1)
+            db = load_postgres(args.dsn, hashes, frame_hashes, frame_video_ids)
+            image_backends[backend] = lambda h, k, d, db=db: db.get_similar_images(h, d, k)
+            video_backends[backend] = db.get_similar_videos_by_hash
+        else:
+            print("Unknown backend %s, expected one of %s" % (backend, BACKENDS), file=sys.stderr)
+            sys.exit(1)
+        build_times[backend] = perf_counter() - start
+
+    # Brute-force distances are computed once, and thresholded for every distance
+    image_truth = [brute_force_distances(hashes, q) for q in query_hashes]
+    video_truth = [brute_force_frame_distances(frame_hashes, q) for q in query_frames] if video_backends else []
+
+    results = []
+    for distance in distances:
+        for name, nearest in image_backends.items():
+            latencies, hits = measure(lambda q: nearest(q.tobytes(), args.k, distance), query_hashes)
+            recalls = [top_k_recall(t, distance, args.k, got) for t, got in zip(image_truth, hits)]
+            results.append(dict(backend=name, type="image", distance=distance, k=args.k,
+                                **summarize(latencies, recalls)))
+
+        for frame_count in frame_counts:
+            if not video_backends:
+                break
+            truth = [brute_force_videos(frame_video_ids, t, distance, frame_count) for t in video_truth]
+            for name, search in video_backends.items():
+                latencies, hits = measure(
+                    lambda q: search([h.tobytes() for h in q], distance, frame_count, None), query_frames)
+                recalls = [video_recall(t, [h[0] for h in got]) for t, got in zip(truth, hits)]
+                results.append(dict(backend=name, type="video", distance=distance, frame_count=frame_count,
+                                    **summarize(latencies, recalls)))
+
+    tmp.cleanup()
+    return {
+        "config": vars(args),
+        "build_seconds": build_times,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1000000, help="Number of image hashes")
+    parser.add_argument("--videos", type=int, default=10000, help="Number of videos")
+    parser.add_argument("--frames", type=int, default=30, help="Frames per video")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--distances", default="0,5,10,15,20,25,30", help='e.g. "0-30" or "0,10,20"')
+    parser.add_argument("--frame-counts", default="1,5,10,20,30")
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--backends", default="bktree,mmap,video_index", type=lambda s: s.split(","))
+    parser.add_argument("--dsn", help="Scratch database for the postgres backend")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import logging
+import os
 import sys
 from logging import FileHandler, StreamHandler
 
@@ -7,18 +8,111 @@ from flask_caching import Cache
 HTTP_PROXY = "http://localhost:5050"
 DBFILE = "dbname=ir user=ir password=ir"
 USE_REDIS = False
+REDIS_HOST = "localhost"
+REDIS_PORT = 6379
 SFW = True
 # SFW = False
 TN_SIZE = 500
 
 SQL_DEBUG = False
 
+# Database connections are pooled per process. Up to DB_POOL_MAX connections are open at once
+# (e.g. one per consumer worker thread), connections idle for more than DB_POOL_PING_INTERVAL
+# seconds are checked before use
+DB_POOL_MIN = 1
+DB_POOL_MAX = 40
+DB_POOL_PING_INTERVAL = 60
+
+# Optional read replica for the search queries (None: everything goes to DBFILE). Searches go to the
+# primary while the replica lags more than REPLICA_MAX_LAG seconds (checked every REPLICA_LAG_CHECK_INTERVAL
+# seconds), and url lookups that find nothing on the replica are retried on the primary if REPLICA_MISS_FALLBACK
+DBFILE_READ = None
+REPLICA_MAX_LAG = 10
+REPLICA_LAG_CHECK_INTERVAL = 5
+REPLICA_MISS_FALLBACK = True
+
+# The consumer writes posts, comments, images and image urls in batches of up to WRITE_BATCH_SIZE
+# rows (0 to write them one by one). Rows submitted while a batch is written make up the next one
+WRITE_BATCH_SIZE = 200
+
+RABBITMQ_HOST = "localhost"
+# Consumers sharing a queue name split the messages between them (named durable queue, messages are kept
+# while no consumer runs, but not across broker restarts unless the producer publishes them persistent).
+# None: every consumer has its own exclusive queue and receives every message
+CONSUMER_QUEUE = None
+
+# rabbitmq_listen.py: worker threads, and unacknowledged messages the broker delivers at once (basic_qos
+# prefetch, also the size of the in-process buffer). Messages are acknowledged once persisted.
+CONSUMER_THREADS = 30
+CONSUMER_PREFETCH = 60
+
+# async_consumer.py: messages processed at once (and concurrent downloads, also the prefetch), and
+# threads used for writing thumbnails
+ASYNC_CONCURRENCY = 200
+ASYNC_CPU_THREADS = 8
+
+# Processes that decode, hash and thumbnail downloaded images (0 to do it in the consumer threads)
+CPU_WORKERS = os.cpu_count()
+
+# pipeline.py: (worker threads, queue size, timeout in seconds) of each stage of the staged consumer.
+# Downloads are abandoned after their timeout (a timeout fails the message), tasks of the other stages
+# that run longer are reported as overdue. Queue depths and stage metrics are logged every
+# PIPELINE_METRICS_INTERVAL seconds
+PIPELINE_STAGES = {
+    "resolve": (8, 64, 60),
+    "download": (30, 64, 120),
+    "dedupe": (4, 64, 10),
+    "hash": (CPU_WORKERS, 2 * CPU_WORKERS, 30),
+    # Writes of concurrent workers share BatchWriter transactions
+    "persist": (16, 128, 30),
+    "thumbnail": (2, 128, 10),
+    "video": (4, 16, 600),
+}
+PIPELINE_METRICS_INTERVAL = 60
+
+# In-memory index used to answer image similarity searches.
+# None: query postgres directly, "bktree": BK-tree loaded at startup,
+# "mmap": memory-mapped hash matrix shared by every worker and appended to by the consumer
+IMAGE_INDEX = None
+HASH_MATRIX_PATH = "index/images"
+
+# Answer video searches from an in-memory inverted index of frame hashes. Substrings are probed up to
+# VIDEO_INDEX_MAX_PROBE_RADIUS bits away from the query's: searches above distance
+# (VIDEO_INDEX_MAX_PROBE_RADIUS + 1) * 9 - 1 can miss frames (see hash_index.VideoFrameIndex)
+VIDEO_INDEX = False
+VIDEO_INDEX_MAX_PROBE_RADIUS = 1
+
+# In-memory indexes are loaded from snapshots in this directory (None to disable),
+# then catch up with rows inserted since, every INDEX_REFRESH_INTERVAL seconds
+SNAPSHOT_DIR = "index/"
+INDEX_REFRESH_INTERVAL = 30
+
+# Unix sockets of the shard workers (see shard.py). When set, similarity searches are
+# scattered to every shard instead of using a local index. Shards that do not answer within
+# SHARD_TIMEOUT seconds are left out and the results are flagged as partial
+SHARD_SOCKETS = []
+SHARD_TIMEOUT = 2
+
+# Image searches up to this distance probe the imagehashchunks table instead
+# of scanning every row of images
+MIH_MAX_DISTANCE = 26
+
+# Hydrated search results of the most requested images/videos are kept in memory, up to
+# RESULT_CACHE_SIZE bytes per process (0 to disable), and in redis when USE_REDIS is set
+RESULT_CACHE_SIZE = 256 * 1024 * 1024
+RESULT_CACHE_TTL = 3600 * 24
+# Without redis, entries can't be invalidated when the consumer adds urls: they are kept this long instead
+RESULT_CACHE_LOCAL_TTL = 60
+
+# /status counters are computed in the background every STATS_REFRESH_INTERVAL seconds
+STATS_REFRESH_INTERVAL = 10
+
 if USE_REDIS:
     cache = Cache(config={
         "CACHE_TYPE": "redis",
         "CACHE_KEY_PREFIX": "ir",
-        "CACHE_REDIS_HOST": "localhost",
-        "CACHE_REDIS_PORT": "6379"
+        "CACHE_REDIS_HOST": REDIS_HOST,
+        "CACHE_REDIS_PORT": str(REDIS_PORT)
     })
 else:
     cache = Cache(config={
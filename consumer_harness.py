@@ -0,0 +1,227 @@
+
+# Local check of how rabbitmq_listen.Consumer shares work, without RabbitMQ, postgres or downloads.
+# An in-process stand-in broker implements the subset of pika's BlockingConnection used by the consumer
+# (topic exchange, exclusive and named queues, basic_qos prefetch, acks, redelivery of unacked messages
+# when a connection closes). Consumers run the real queue declaration, buffering and ack code, with a
+# message handler that only sleeps.
+#
+# usage: python consumer_harness.py [--consumers 3] [--messages 2000] [--queue irarchives] [--crash]
+# Without --queue every consumer has its own exclusive queue (and receives every message).
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from types import SimpleNamespace
+
+from rabbitmq_listen import Consumer
+from util import load_list
+
+
+def _topic_match(pattern, routing_key):
+    pattern, key = pattern.split("."), routing_key.split(".")
+    return len(pattern) == len(key) and all(p in ("*", k) for p, k in zip(pattern, key))
+
+
+class StandInBroker:
+    """ Single exchange, single channel per connection. Messages are redelivered at the head of the queue """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.queues = {}
+        self.bindings = []
+        self.acks = Counter()
+        self.redelivered = 0
+        self._next_tag = 0
+
+    def connect(self):
+        return StandInConnection(self)
+
+    def publish(self, routing_key, body):
+        with self.lock:
+            for pattern, queue in self.bindings:
+                if _topic_match(pattern, routing_key):
+                    self.queues[queue].append((body, False))
+            self.lock.notify_all()
+
+    def pending(self):
+        with self.lock:
+            return sum(len(q) for q in self.queues.values())
+
+
+class StandInConnection:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.open = True
+        self.queue = None
+        self.exclusive = False
+        self.prefetch = 0
+        self.callback = None
+        self.unacked = {}
+        self.max_unacked = 0
+        self.acked = 0
+        self._callbacks = deque()
+
+    # pika.BlockingConnection
+
+    def channel(self):
+        return self
+
+    def add_callback_threadsafe(self, callback):
+        with self.broker.lock:
+            if self.open:
+                self._callbacks.append(callback)
+                self.broker.lock.notify_all()
+
+    def close(self):
+        """ Like a crash: unacked messages go back to the queue, an exclusive queue is deleted """
+        with self.broker.lock:
+            self.open = False
+            if self.exclusive:
+                del self.broker.queues[self.queue]
+                self.broker.bindings = [b for b in self.broker.bindings if b[1] != self.queue]
+            else:
+                for tag in sorted(self.unacked, reverse=True):
+                    self.broker.queues[self.queue].appendleft((self.unacked[tag], True))
+            self.unacked.clear()
+            self.broker.lock.notify_all()
+
+    # pika.channel.Channel
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def queue_declare(self, queue, durable=False, exclusive=False):
+        with self.broker.lock:
+            if not queue:
+                queue = "amq.gen-%d" % id(self)
+            self.broker.queues.setdefault(queue, deque())
+        self.queue, self.exclusive = queue, exclusive
+        return SimpleNamespace(method=SimpleNamespace(queue=queue))
+
+    def queue_bind(self, exchange, queue, routing_key):
+        with self.broker.lock:
+            if (routing_key, queue) not in self.broker.bindings:
+                self.broker.bindings.append((routing_key, queue))
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        assert not auto_ack
+        self.callback = on_message_callback
+
+    def basic_ack(self, delivery_tag):
+        body = self.unacked.pop(delivery_tag)
+        self.broker.acks[json.loads(body)[0]["id"]] += 1
+        self.acked += 1
+
+    def basic_nack(self, delivery_tag, requeue):
+        body = self.unacked.pop(delivery_tag)
+        if requeue:
+            self.broker.queues[self.queue].appendleft((body, True))
+
+    def start_consuming(self):
+        broker = self.broker
+        while True:
+            with broker.lock:
+                while self.open and not self._callbacks and \
+                        (len(self.unacked) >= self.prefetch or not broker.queues[self.queue]):
+                    broker.lock.wait(0.1)
+                if not self.open:
+                    return
+                callbacks, self._callbacks = self._callbacks, deque()
+                for callback in callbacks:
+                    callback()
+
+                deliveries = []
+                while len(self.unacked) < self.prefetch and broker.queues[self.queue]:
+                    body, redelivered = broker.queues[self.queue].popleft()
+                    broker._next_tag += 1
+                    broker.redelivered += redelivered
+                    self.unacked[broker._next_tag] = body
+                    deliveries.append((broker._next_tag, redelivered, body))
+                self.max_unacked = max(self.max_unacked, len(self.unacked))
+
+            for tag, redelivered, body in deliveries:
+                self.callback(self, SimpleNamespace(delivery_tag=tag, redelivered=redelivered), None, body)
+
+
+class HarnessConsumer(Consumer):
+    """ The consumer's queue and ack handling only: messages are not parsed, nothing is downloaded or stored """
+
+    def __init__(self, connection, queue, threads, prefetch, delay):
+        self.threads = threads
+        self.delay = delay
+        self._rabbitmq = connection
+        self._declare_queue(queue, prefetch)
+
+    def _message_callback(self, body, web):
+        time.sleep(random.uniform(0, 2 * self.delay))
+        if not self._rabbitmq.open:
+            # The process is gone, nothing is persisted
+            threading.Event().wait()
+
+
+def run(args):
+    random.seed(args.seed)
+    broker = StandInBroker()
+    consumers = []
+    for _ in range(args.consumers):
+        connection = broker.connect()
+        consumer = HarnessConsumer(connection, args.queue, args.threads, args.prefetch, args.delay)
+        threading.Thread(target=consumer.run, daemon=True).start()
+        consumers.append((connection, consumer))
+
+    # basic_consume() is called once the queue is bound
+    while any(c.callback is None for c, _ in consumers):
+        time.sleep(0.01)
+
+    subs = load_list("subs.txt")
+
+    start = time.time()
+    for i in range(args.messages):
+        broker.publish("post.%s" % random.choice(subs), json.dumps([{"id": i}]))
+        if args.crash and i == args.messages // 2:
+            consumers[0][0].close()
+
+    while broker.pending() or any(c.unacked for c, _ in consumers if c.open):
+        time.sleep(0.05)
+
+    report = {
+        "config": vars(args),
+        "seconds": round(time.time() - start, 2),
+        "acked_per_consumer": [c.acked for c, _ in consumers],
+        "messages_acked": len(broker.acks),
+        "messages_lost": args.messages - len(broker.acks),
+        "messages_acked_more_than_once": sum(1 for n in broker.acks.values() if n > 1),
+        "redeliveries": broker.redelivered,
+        "max_unacked_per_consumer": [c.max_unacked for c, _ in consumers],
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--consumers", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--queue", help="Shared queue name (default: one exclusive queue per consumer)")
+    parser.add_argument("--threads", type=int, default=8, help="Worker threads per consumer")
+    parser.add_argument("--prefetch", type=int, default=16, help="Prefetch per consumer")
+    parser.add_argument("--delay", type=float, default=0.05, help="Mean processing time of a message (s)")
+    parser.add_argument("--crash", action="store_true", help="Close the first consumer's connection halfway")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.queue and report["messages_lost"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
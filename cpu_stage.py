@@ -0,0 +1,119 @@
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+
+from common import logger, CPU_WORKERS
+from img_util import image_from_buffer, get_hash, thumbnail_bytes
+
+# Buffers at least this large are handed to the workers through shared memory instead of being pickled
+SHARED_MEMORY_MIN_SIZE = 256 * 1024
+
+ImageInfo = namedtuple("ImageInfo", ["hash", "width", "height", "thumbnail"])
+
+
+def process_image(image_buffer):
+    """ Returns the ImageInfo of an encoded image. The thumbnail is JPEG encoded """
+    im = image_from_buffer(image_buffer)
+    width, height = im.size
+    return ImageInfo(get_hash(im), width, height, thumbnail_bytes(im))
+
+
+def _process_shared_image(name, size):
+    shm = SharedMemory(name=name)
+    buffer = shm.buf[:size]
+    try:
+        return process_image(buffer)
+    finally:
+        buffer.release()
+        shm.close()
+
+
+class CpuStage:
+    """
+        Decodes, hashes and thumbnails images in a pool of worker processes, so that the CPU work of the
+        consumers is not serialized by the GIL. With workers=0 images are processed in the calling thread.
+        A worker that dies (e.g. killed for running out of memory) breaks the pool: it is replaced and
+        the images it was processing are submitted once more.
+    """
+
+    def __init__(self, workers=CPU_WORKERS):
+        self.workers = workers
+        self._lock = Lock()
+        self._pool = self._new_pool() if workers > 0 else None
+
+    def _new_pool(self):
+        # Forking a process that runs threads (the consumers) is unsafe
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("forkserver"))
+
+    def submit(self, image_buffer):
+        """ Returns a Future of the ImageInfo of image_buffer """
+        result = Future()
+        result.set_running_or_notify_cancel()
+
+        if self._pool is None:
+            try:
+                result.set_result(process_image(image_buffer))
+            except Exception as e:
+                result.set_exception(e)
+            return result
+
+        self._submit(image_buffer, result, retries=1)
+        return result
+
+    def _submit(self, image_buffer, result, retries):
+        pool = self._pool
+        try:
+            future = self._submit_to(pool, image_buffer)
+        except BrokenProcessPool as e:
+            self._on_broken(pool, e, image_buffer, result, retries)
+            return
+
+        def done(f):
+            e = f.exception()
+            if isinstance(e, BrokenProcessPool):
+                self._on_broken(pool, e, image_buffer, result, retries)
+            elif e is not None:
+                result.set_exception(e)
+            else:
+                result.set_result(f.result())
+
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _submit_to(pool, image_buffer):
+        if len(image_buffer) < SHARED_MEMORY_MIN_SIZE:
+            return pool.submit(process_image, image_buffer)
+
+        shm = SharedMemory(create=True, size=len(image_buffer))
+
+        def release(_=None):
+            shm.close()
+            shm.unlink()
+
+        try:
+            shm.buf[:len(image_buffer)] = image_buffer
+            future = pool.submit(_process_shared_image, shm.name, len(image_buffer))
+        except:
+            release()
+            raise
+        future.add_done_callback(release)
+        return future
+
+    def _on_broken(self, pool, err, image_buffer, result, retries):
+        if not retries:
+            result.set_exception(err)
+            return
+
+        with self._lock:
+            if self._pool is pool:
+                logger.warning("Image processing pool is broken, starting a new one: %s" % (err, ))
+                pool.shutdown(wait=False)
+                self._pool = self._new_pool()
+        self._submit(image_buffer, result, retries - 1)
+
+    def process(self, image_buffer):
+        """ Blocking version of submit() """
+        return self.submit(image_buffer).result()
@@ -0,0 +1,551 @@
+import fcntl
+import heapq
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import time, sleep
+
+import numpy as np
+
+from common import logger, HASH_MATRIX_PATH, SNAPSHOT_DIR, INDEX_REFRESH_INTERVAL, VIDEO_INDEX_MAX_PROBE_RADIUS
+from hash_snapshot import read_snapshot, write_snapshot, SnapshotError
+from hash_util import hash_to_int, int_to_hash, hamming, hash_chunks, chunk_neighbours, HASH_BYTES, HASH_CHUNKS
+
+# Rows re-read below the high-water mark on every update, see _Delta
+WATERMARK_OVERLAP = 1000
+
+# Node layout: [hash, [item ids], {distance: child node}]
+_HASH = 0
+_IDS = 1
+_CHILDREN = 2
+
+
+class BKTree:
+    """
+        Burkhard-Keller tree over 144-bit hashes, with hamming distance as the metric.
+        Identical hashes share a node, so exact (d=0) queries only follow one path.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash, item_id):
+        h = hash_to_int(hash)
+        self.size += 1
+
+        if self.root is None:
+            self.root = [h, [item_id], {}]
+            return
+
+        node = self.root
+        while True:
+            d = hamming(h, node[_HASH])
+            if d == 0:
+                node[_IDS].append(item_id)
+                return
+            child = node[_CHILDREN].get(d)
+            if child is None:
+                node[_CHILDREN][d] = [h, [item_id], {}]
+                return
+            node = child
+
+    def search(self, hash, distance=0):
+        """ Returns the ids of all items within <distance> of hash """
+        if self.root is None:
+            return []
+
+        h = hash_to_int(hash)
+        result = []
+        stack = [self.root]
+
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[_HASH])
+            if d <= distance:
+                result.extend(node[_IDS])
+
+            children = node[_CHILDREN]
+            # Triangle inequality: only subtrees at distance [d - r, d + r] can contain matches
+            for k in range(max(d - distance, 1), d + distance + 1):
+                child = children.get(k)
+                if child is not None:
+                    stack.append(child)
+
+        return result
+
+    def items(self):
+        """ Yields (id, hash) for every item in the tree """
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            h = int_to_hash(node[_HASH])
+            for item_id in node[_IDS]:
+                yield item_id, h
+            stack.extend(node[_CHILDREN].values())
+
+    def nearest(self, hash, k, distance, after=None):
+        """
+            Returns up to k (id, distance) tuples within <distance> of hash, ordered by (distance, id).
+            Once k items are found, the search radius shrinks to the distance of the worst of them.
+            * after - optional (distance, id) cursor, only items ordered after it are returned
+        """
+        if self.root is None:
+            return []
+
+        h = hash_to_int(hash)
+        best = []  # max-heap of (-distance, -id)
+        radius = distance
+        stack = [self.root]
+
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[_HASH])
+            if d <= radius:
+                for item_id in node[_IDS]:
+                    if after is not None and (d, item_id) <= after:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-d, -item_id))
+                    elif (-d, -item_id) > best[0]:
+                        heapq.heapreplace(best, (-d, -item_id))
+                if len(best) == k:
+                    radius = -best[0][0]
+
+            children = node[_CHILDREN]
+            for c in range(max(d - radius, 1), d + radius + 1):
+                child = children.get(c)
+                if child is not None:
+                    stack.append(child)
+
+        return sorted(((-item_id, -d) for d, item_id in best), key=lambda x: (x[1], x[0]))
+
+
+try:
+    _popcount = np.bitwise_count
+except AttributeError:
+    _POPCOUNT16 = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+    def _popcount(a):
+        return _POPCOUNT16[a]
+
+# Hashes are scanned in blocks to bound the size of temporary arrays
+_SCAN_BLOCK = 1 << 20
+
+
+class MmapHashIndex:
+    """
+        Every hash is stored in a contiguous, memory-mapped <path>.hashes file (HASH_BYTES per row),
+        next to a parallel <path>.ids file of int64 item ids. Files are append-only and mapped
+        read-only, so every process that opens them shares the same pages.
+        Writers (consumers, builds) hold an exclusive lock on <path>.lock, so both files always grow together.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._hashes_file = path + ".hashes"
+        self._ids_file = path + ".ids"
+        self._lock_file = path + ".lock"
+        # Created once a build completed: the files may hold a partial matrix before that
+        self._built_file = path + ".built"
+        self._write_lock = Lock()
+        self._mapped_size = 0
+        self._mapped_inode = None
+        self._hashes = np.empty((0, HASH_BYTES // 2), dtype=np.uint16)
+        self._ids = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        self._remap()
+        return self._mapped_size
+
+    def exists(self):
+        return os.path.exists(self._built_file)
+
+    @contextmanager
+    def _flock(self, lock_file):
+        """ Exclusive lock on lock_file, across processes """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _remap(self):
+        """ Picks up rows appended since the last call, or the files of a new build """
+        try:
+            inode = os.stat(self._ids_file).st_ino
+            size = min(os.path.getsize(self._ids_file) // 8,
+                       os.path.getsize(self._hashes_file) // HASH_BYTES)
+        except FileNotFoundError:
+            return
+        if (size == self._mapped_size and inode == self._mapped_inode) or size == 0:
+            return
+
+        self._hashes = np.memmap(self._hashes_file, dtype=np.uint16, mode="r", shape=(size, HASH_BYTES // 2))
+        self._ids = np.memmap(self._ids_file, dtype=np.int64, mode="r", shape=(size,))
+        self._mapped_size = size
+        self._mapped_inode = inode
+
+    def _tail_ids(self):
+        """ Ids of the last WATERMARK_OVERLAP rows """
+        try:
+            with open(self._ids_file, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(f.tell() - WATERMARK_OVERLAP * 8, 0))
+                return set(np.frombuffer(f.read(), dtype=np.int64).tolist())
+        except FileNotFoundError:
+            return set()
+
+    def append(self, item_id, hash):
+        self.extend([item_id], [hash])
+
+    def extend(self, item_ids, hashes):
+        with self._write_lock, self._flock(self._lock_file):
+            self._write(item_ids, hashes)
+
+    def _write(self, item_ids, hashes):
+        # A build may have replayed rows that were inserted while it ran
+        recent = self._tail_ids()
+        rows = [(i, h) for i, h in zip(item_ids, hashes) if i not in recent]
+        if not rows:
+            return
+        with open(self._hashes_file, "ab") as f:
+            f.write(b"".join(bytes(h) for _, h in rows))
+        with open(self._ids_file, "ab") as f:
+            f.write(np.array([i for i, _ in rows], dtype=np.int64).tobytes())
+
+    def _distances(self, hash):
+        """ Yields (ids, distances) for every block of the matrix """
+        self._remap()
+        query = np.frombuffer(bytes(hash), dtype=np.uint16)
+
+        for start in range(0, self._mapped_size, _SCAN_BLOCK):
+            block = self._hashes[start:start + _SCAN_BLOCK]
+            distances = _popcount(np.bitwise_xor(block, query)).sum(axis=1, dtype=np.uint16)
+            yield self._ids[start:start + _SCAN_BLOCK], distances
+
+    def search(self, hash, distance=0):
+        """ Returns the ids of all items within <distance> of hash """
+        result = [ids[distances <= distance] for ids, distances in self._distances(hash)]
+        if not result:
+            return []
+        return np.unique(np.concatenate(result)).tolist()
+
+    def nearest(self, hash, k, distance, after=None):
+        """
+            Returns up to k (id, distance) tuples within <distance> of hash, ordered by (distance, id)
+            * after - optional (distance, id) cursor, only items ordered after it are returned
+        """
+        best_ids = []
+        best_distances = []
+        for ids, distances in self._distances(hash):
+            mask = distances <= distance
+            if after is not None:
+                mask &= (distances > after[0]) | ((distances == after[0]) & (ids > after[1]))
+            best_ids.append(ids[mask])
+            best_distances.append(distances[mask])
+        if not best_ids:
+            return []
+
+        ids = np.concatenate(best_ids)
+        distances = np.concatenate(best_distances)
+        if len(ids) > k:
+            # Ties at the k-th distance are kept, they are ranked by id below
+            top = distances <= np.partition(distances, k - 1)[k - 1]
+            ids, distances = ids[top], distances[top]
+        order = np.lexsort((ids, distances))[:k]
+        return [(int(ids[i]), int(distances[i])) for i in order]
+
+    def build(self, db):
+        """
+            Writes every image hash of the database to a fresh matrix, unless another process
+            built it while this one waited for the build lock
+        """
+        with self._flock(self.path + ".build.lock"):
+            if self.exists():
+                return
+            self._build(db)
+
+    def _build(self, db):
+        tmp_path = "%s.tmp.%d" % (self.path, os.getpid())
+        tmp_hashes, tmp_ids = tmp_path + ".hashes", tmp_path + ".ids"
+        max_id = 0
+        with open(tmp_hashes, "wb") as hashes_file, open(tmp_ids, "wb") as ids_file:
+            batch_ids = []
+            batch_hashes = []
+            for image_id, image_hash in db.get_image_hashes():
+                batch_ids.append(image_id)
+                batch_hashes.append(bytes(image_hash))
+                if len(batch_ids) >= 100000:
+                    hashes_file.write(b"".join(batch_hashes))
+                    ids_file.write(np.array(batch_ids, dtype=np.int64).tobytes())
+                    max_id = max(max_id, max(batch_ids))
+                    batch_ids.clear()
+                    batch_hashes.clear()
+            hashes_file.write(b"".join(batch_hashes))
+            ids_file.write(np.array(batch_ids, dtype=np.int64).tobytes())
+            max_id = max([max_id] + batch_ids)
+
+        with self._write_lock, self._flock(self._lock_file):
+            os.rename(tmp_hashes, self._hashes_file)
+            os.rename(tmp_ids, self._ids_file)
+            # Rows committed during the build were appended to the replaced files: replay them from the primary.
+            # Serial ids are allocated before commit, so WATERMARK_OVERLAP ids below the last one are read again
+            replay_ids, replay_hashes = [], []
+            for image_id, image_hash in db.get_image_hashes(max(max_id - WATERMARK_OVERLAP, 0), primary=True):
+                replay_ids.append(image_id)
+                replay_hashes.append(image_hash)
+            self._write(replay_ids, replay_hashes)
+            open(self._built_file, "w").close()
+
+
+class VideoFrameIndex:
+    """
+        Inverted index from video frame hashes to the ids of the videos containing them.
+        Every distinct frame hash is also filed under each of its substrings (see hash_util.hash_chunks())
+        so that radius queries only verify frames sharing a nearby substring with the query.
+        A substring within r bits has C(16, 0) + ... + C(16, r) values, and about that many 65536ths of the
+        frames share one of them, so the probe radius is capped at max_probe_radius: up to distance
+        (max_probe_radius + 1) * HASH_CHUNKS - 1 (17 by default) every match is found, above it only frames
+        with a substring within max_probe_radius bits of the query's are (the search is approximate).
+        Candidates are always verified with the full distance.
+    """
+
+    def __init__(self, max_probe_radius=VIDEO_INDEX_MAX_PROBE_RADIUS):
+        self.max_probe_radius = max_probe_radius
+        self._hashes = []  # Distinct frame hashes
+        self._videos = []  # Video ids of each distinct frame hash
+        self._positions = {}  # frame hash -> position in _hashes
+        self._chunks = [defaultdict(list) for _ in range(HASH_CHUNKS)]  # substring -> positions
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash, video_id):
+        h = hash_to_int(hash)
+        self.size += 1
+
+        pos = self._positions.get(h)
+        if pos is not None:
+            self._videos[pos].append(video_id)
+            return
+
+        # _positions is updated last so that concurrent searches never see a partial entry
+        pos = len(self._hashes)
+        self._hashes.append(h)
+        self._videos.append([video_id])
+        self._positions[h] = pos
+        for i, value in enumerate(hash_chunks(h)):
+            self._chunks[i][value].append(pos)
+
+    def items(self):
+        """ Yields (video id, hash) for every frame in the index """
+        for h, video_ids in zip(self._hashes, self._videos):
+            h = int_to_hash(h)
+            for video_id in video_ids:
+                yield video_id, h
+
+    def _matching_frames(self, hashes, distance):
+        """ Positions of the stored frame hashes within <distance> of any of the query hashes """
+        if distance <= 0:
+            return {self._positions[h] for h in hashes if h in self._positions}
+
+        radius = min(distance // HASH_CHUNKS, self.max_probe_radius)
+        matched = set()
+        for h in hashes:
+            candidates = set()
+            for i, value in enumerate(hash_chunks(h)):
+                table = self._chunks[i]
+                for v in chunk_neighbours(value, radius):
+                    positions = table.get(v)
+                    if positions:
+                        candidates.update(positions)
+
+            candidates -= matched
+            matched.update(pos for pos in candidates if hamming(h, self._hashes[pos]) <= distance)
+        return matched
+
+    def search(self, hashes, distance, frame_count, k=None):
+        """ Returns up to k (video id, matched frame count) tuples, most matched frames first """
+        votes = defaultdict(int)
+        hits = []
+
+        for pos in self._matching_frames({hash_to_int(h) for h in hashes}, distance):
+            for video_id in self._videos[pos]:
+                votes[video_id] += 1
+                if votes[video_id] == frame_count:
+                    hits.append(video_id)
+
+        hits = sorted(((video_id, votes[video_id]) for video_id in hits), key=lambda hit: (-hit[1], hit[0]))
+        return hits[:k] if k else hits
+
+
+class _Delta:
+    """
+        Tracks which database rows an index already contains.
+        Serial ids are allocated before commit, so a row can become visible after a higher id was read:
+        every update reads WATERMARK_OVERLAP ids below the high-water mark again and skips the keys it has seen.
+    """
+
+    def __init__(self, watermark=0, keys=(), shard=None):
+        self.watermark = watermark
+        self.shard = shard
+        self._recent = {key: watermark for key in keys}
+
+    def start(self):
+        return max(self.watermark - WATERMARK_OVERLAP, 0)
+
+    def is_new(self, row_id, key):
+        seen = self._recent.get(key)
+        self._recent[key] = row_id if seen is None else max(seen, row_id)
+        self.watermark = max(self.watermark, row_id)
+        return seen is None
+
+    def prune(self):
+        low = self.watermark - WATERMARK_OVERLAP
+        self._recent = {key: row_id for key, row_id in self._recent.items() if row_id > low}
+
+
+def _snapshot_name(name, shard):
+    return name if shard is None else "%s.%d-%d" % (name, shard[0], shard[1])
+
+
+def _snapshot_path(name):
+    return os.path.join(SNAPSHOT_DIR, name + ".snap") if SNAPSHOT_DIR else None
+
+
+def _load_snapshot(index, name):
+    """ Fills the index from its snapshot, returns the ids it contained """
+    path = _snapshot_path(name)
+    if not path or not os.path.exists(path):
+        return 0, []
+
+    try:
+        ids, hashes, watermark = read_snapshot(path)
+    except SnapshotError as e:
+        logger.warning("Ignoring snapshot: %s" % (e, ))
+        return 0, []
+
+    ids = ids.tolist()
+    for item_id, h in zip(ids, hashes):
+        index.add(h.tobytes(), item_id)
+    return watermark, ids
+
+
+def save_snapshot(index, name):
+    path = _snapshot_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ids, hashes = [], []
+    for item_id, h in index.items():
+        ids.append(item_id)
+        hashes.append(h)
+    write_snapshot(path, ids, hashes, index.delta.watermark)
+
+
+def update_image_index(index, db):
+    """ Adds images inserted since the last update, returns how many were added """
+    delta = getattr(index, "delta", None)
+    if delta is None:
+        # The hash matrix is appended to by the consumer
+        return 0
+
+    count = 0
+    for image_id, image_hash in db.get_image_hashes(delta.start(), delta.shard):
+        if delta.is_new(image_id, image_id):
+            index.add(image_hash, image_id)
+            count += 1
+    delta.prune()
+    return count
+
+
+def update_video_index(index, db):
+    """ Adds video frames inserted since the last update, returns how many were added """
+    delta = index.delta
+    # All the frames of a video are inserted in a single statement, so they are either all visible or not at all
+    new_videos = set()
+    count = 0
+    for frame_id, video_id, frame_hash in db.get_video_frame_hashes(delta.start(), delta.shard):
+        if delta.is_new(frame_id, video_id) or video_id in new_videos:
+            new_videos.add(video_id)
+            index.add(frame_hash, video_id)
+            count += 1
+    delta.prune()
+    return count
+
+
+def load_video_index(db, shard=None):
+    """
+        Returns the video frame index
+        * shard - optional (shard, shard count) tuple, only loads videos where id % shard count = shard
+    """
+    start = time()
+    name = _snapshot_name("videoframes", shard)
+    index = VideoFrameIndex()
+    watermark, video_ids = _load_snapshot(index, name)
+    # Frame ids are not part of the snapshot: the most recent videos are used as the keys of the overlap window
+    recent = max(video_ids, default=0) - WATERMARK_OVERLAP
+    index.delta = _Delta(watermark, {v for v in video_ids if v > recent}, shard)
+    logger.info("Loaded %d video frame hashes from snapshot in %.2fs" % (len(index), time() - start))
+
+    if update_video_index(index, db) and SNAPSHOT_DIR:
+        save_snapshot(index, name)
+
+    logger.info("Loaded %d video frame hashes in %.2fs" % (len(index), time() - start))
+    return index
+
+
+def load_image_index(db, kind, shard=None):
+    """
+        Returns the image hash index selected by common.IMAGE_INDEX
+        * shard - optional (shard, shard count) tuple, only loads images where id % shard count = shard
+    """
+    start = time()
+
+    if kind == "bktree":
+        name = _snapshot_name("images", shard)
+        index = BKTree()
+        watermark, image_ids = _load_snapshot(index, name)
+        index.delta = _Delta(watermark, (i for i in image_ids if i > watermark - WATERMARK_OVERLAP), shard)
+        logger.info("Loaded %d image hashes from snapshot in %.2fs" % (len(index), time() - start))
+
+        if update_image_index(index, db) and SNAPSHOT_DIR:
+            save_snapshot(index, name)
+    elif kind == "mmap" and shard is not None:
+        raise ValueError("The hash matrix cannot be sharded")
+    elif kind == "mmap":
+        index = MmapHashIndex(HASH_MATRIX_PATH)
+        if not index.exists():
+            logger.info("Building hash matrix %s" % (HASH_MATRIX_PATH, ))
+            index.build(db)
+    else:
+        raise ValueError("Unknown image index: %s" % kind)
+
+    logger.info("Loaded %d image hashes in %.2fs" % (len(index), time() - start))
+    return index
+
+
+def start_refresh_thread(db, image_index, video_index):
+    """ Keeps the indexes up to date with the database in a background thread.
+     db should not be shared with other threads: updates stream rows with server-side cursors """
+
+    def refresh():
+        while True:
+            sleep(INDEX_REFRESH_INTERVAL)
+            try:
+                if image_index is not None:
+                    update_image_index(image_index, db)
+                if video_index is not None:
+                    update_video_index(video_index, db)
+            except Exception as e:
+                logger.error("Could not refresh hash indexes: %s" % (e, ))
+
+    t = Thread(target=refresh, daemon=True)
+    t.start()
+    return t
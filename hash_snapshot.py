@@ -0,0 +1,61 @@
+import os
+import struct
+
+import numpy as np
+
+from hash_util import HASH_BYTES
+
+# Snapshot file layout (little endian):
+#   header:  magic (4s), version (H), hash size in bytes (H), row count (Q), high-water mark id (Q)
+#   ids:     row count * int64
+#   hashes:  row count * hash size bytes
+MAGIC = b"IRHS"
+VERSION = 1
+_HEADER = struct.Struct("<4sHHQQ")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_snapshot(path, ids, hashes, watermark):
+    """
+        Atomically writes a snapshot
+        * ids - item ids, one per hash
+        * hashes - iterable of HASH_BYTES-long hashes
+        * watermark - id of the last database row included in the snapshot
+    """
+    ids = np.asarray(ids, dtype="<i8")
+    packed = b"".join(bytes(h) for h in hashes)
+    if len(packed) != len(ids) * HASH_BYTES:
+        raise SnapshotError("Expected %d hashes of %d bytes" % (len(ids), HASH_BYTES))
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, HASH_BYTES, len(ids), watermark))
+        f.write(ids.tobytes())
+        f.write(packed)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path):
+    """ Returns (ids, hashes, watermark). hashes is a (count, HASH_BYTES) uint8 array """
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise SnapshotError("Truncated snapshot header: %s" % path)
+
+        magic, version, hash_bytes, count, watermark = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise SnapshotError("Not a hash snapshot: %s" % path)
+        if version != VERSION:
+            raise SnapshotError("Unsupported snapshot version %d: %s" % (version, path))
+        if hash_bytes != HASH_BYTES:
+            raise SnapshotError("Unexpected hash size %d: %s" % (hash_bytes, path))
+
+        ids = np.fromfile(f, dtype="<i8", count=count)
+        hashes = np.fromfile(f, dtype=np.uint8, count=count * hash_bytes)
+        if len(ids) != count or len(hashes) != count * hash_bytes:
+            raise SnapshotError("Truncated snapshot: %s" % path)
+
+    return ids, hashes.reshape((count, hash_bytes)), watermark
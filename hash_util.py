@@ -0,0 +1,45 @@
+from functools import lru_cache
+from itertools import combinations
+
+from gmpy2 import popcount
+
+HASH_BYTES = 18
+HASH_BITS = HASH_BYTES * 8
+
+
+def hash_to_int(h):
+    """ 18-byte (big endian) dhash as returned by img_util.get_hash -> int """
+    return int.from_bytes(bytes(h), "big")
+
+
+def int_to_hash(h):
+    return h.to_bytes(HASH_BYTES, "big")
+
+
+def hamming(a, b):
+    """ Hamming distance between two integer hashes """
+    return popcount(a ^ b)
+
+
+# Multi-index hashing: the hash is split into HASH_CHUNKS disjoint 16-bit substrings.
+# If two hashes are within distance d, at least one of their substrings is within d // HASH_CHUNKS
+HASH_CHUNKS = 9
+CHUNK_BITS = HASH_BITS // HASH_CHUNKS
+_CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def hash_chunks(h):
+    """ Splits an integer hash into its HASH_CHUNKS substrings (least significant first) """
+    return [(h >> (i * CHUNK_BITS)) & _CHUNK_MASK for i in range(HASH_CHUNKS)]
+
+
+@lru_cache(maxsize=None)
+def _neighbour_masks(radius):
+    """ Masks of every combination of up to <radius> bits of a chunk """
+    return [0] + [sum(1 << b for b in bits)
+                  for r in range(1, radius + 1) for bits in combinations(range(CHUNK_BITS), r)]
+
+
+def chunk_neighbours(value, radius):
+    """ Returns every chunk value within <radius> bits of value (including value itself) """
+    return [value ^ mask for mask in _neighbour_masks(radius)]
@@ -3,14 +3,16 @@ import os
 from io import BytesIO, StringIO
 
 import sys
+import numpy as np
 from PIL import Image
 from gallery_dl import job, config
 from gallery_dl.job import UrlJob
-from imagehash import dhash
 
 from common import logger, HTTP_PROXY, TN_SIZE
 from util import thumb_path
 
+HASH_SIZE = 12
+
 
 class ListUrlJob(UrlJob):
     def __init__(self, url):
@@ -48,6 +50,24 @@ def create_thumb(im, num):
         Creates a thumbnail for a given image file.
         Saves to 'thumbs' directory, named <num>.jpg
     """
+    save_thumb(thumbnail_bytes(im), num)
+
+
+def thumbnail_bytes(im):
+    """ JPEG encoded thumbnail of an image, at most TN_SIZE x TN_SIZE """
+
+    # Convert to RGB if not already
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    im.thumbnail((TN_SIZE, TN_SIZE), Image.ANTIALIAS)
+
+    buffer = BytesIO()
+    im.save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def save_thumb(data, num):
+    """ Saves an encoded thumbnail to 'thumbs' directory, named <num>.jpg """
 
     dirpath = thumb_path(num)
 
@@ -57,18 +77,34 @@ def create_thumb(im, num):
         logger.warn("Could not create dir: %s" % (e, ))
         pass
 
-    # Convert to RGB if not already
-    if im.mode != "RGB":
-        im = im.convert("RGB")
-    im.thumbnail((TN_SIZE, TN_SIZE), Image.ANTIALIAS)
-
-    im.save(os.path.join(dirpath, str(num) + ".jpg"), 'JPEG')
+    with open(os.path.join(dirpath, str(num) + ".jpg"), "wb") as f:
+        f.write(data)
 
 
 def get_sha1(buffer):
     return hashlib.sha1(buffer).hexdigest()
 
 
+def _dhash_pixels(im):
+    """ Same preprocessing as imagehash.dhash() """
+    return np.asarray(im.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.ANTIALIAS))
+
+
 def get_hash(im):
-    return sum(1 << i for i, b in enumerate(dhash(im, hash_size=12).hash.flatten()) if b)\
-        .to_bytes(18, "big")
+    return get_hashes([im])[0]
+
+
+def get_hashes(images):
+    """
+        Computes the dhash of many images at once.
+        * images - list of PIL images, or array of grayscale pixels with shape (N, HASH_SIZE, HASH_SIZE + 1)
+    """
+    if not isinstance(images, np.ndarray):
+        if not images:
+            return []
+        images = np.stack([_dhash_pixels(im) for im in images])
+
+    diff = images[:, :, 1:] > images[:, :, :-1]
+    # Bit i of the flattened difference matrix is bit i of the big endian 18-byte integer
+    packed = np.packbits(diff.reshape(len(diff), -1), axis=1, bitorder="little")[:, ::-1]
+    return [row.tobytes() for row in packed]
@@ -0,0 +1,138 @@
+import re
+import sys
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from common import logger, DBFILE
+from hash_util import hash_chunks, hash_to_int
+
+# Serializes migrations of concurrent processes (pg_advisory_lock key)
+LOCK_KEY = 0x6972736d
+
+
+def _index(table, column, method="btree"):
+    return "CREATE INDEX CONCURRENTLY IF NOT EXISTS %s_%s_index ON %s USING %s (%s)" % (
+        table, column, table, method, column)
+
+
+def _write_hash_chunks(cur, rows):
+    execute_values(cur, "INSERT INTO imagehashchunks (imageid, chunk, value) VALUES %s ON CONFLICT DO NOTHING",
+                   [(imageid, i, value) for imageid, imhash in rows
+                    for i, value in enumerate(hash_chunks(hash_to_int(bytes(imhash))))],
+                   page_size=10000)
+
+
+def _fill_hash_chunks(db_file):
+    """ Substrings of the images inserted before imagehashchunks existed, new images get theirs when inserted """
+    import backfill
+    from DB import DB
+    from rabbitmq_listen import SCHEMA
+
+    db = DB(db_file, ImageHashChunks=SCHEMA["ImageHashChunks"])
+    backfill.run(db, "imagehashchunks", "images", ["hash"], _write_hash_chunks, where="hash IS NOT NULL")
+
+
+# Schema upgrades of the tables created from rabbitmq_listen.SCHEMA, applied in order.
+# Steps are idempotent so that a migration interrupted halfway can be applied again. SQL statements run in
+# autocommit mode: CREATE INDEX CONCURRENTLY does not block writes on a live database but cannot run
+# inside a transaction. Data is filled by functions of the connection string, with backfill.run() so that
+# no transaction outlives a chunk of rows.
+MIGRATIONS = [
+    # 1: url lookups, result hydration and author searches
+    [
+        _index("imageurls", "clean_url"),
+        _index("imageurls", "imageid"),
+        _index("imageurls", "postid"),
+        _index("imageurls", "commentid"),
+        _index("imageurls", "albumid"),
+        _index("videourls", "clean_url"),
+        _index("videourls", "videoid"),
+        _index("videourls", "postid"),
+        _index("videourls", "commentid"),
+        _index("videoframes", "videoid"),
+        _index("comments", "postid"),
+        _index("posts", "author"),
+        _index("comments", "author"),
+    ],
+    # 2: full-text search, the columns are filled by update_tsv.py
+    [
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS tsv tsvector",
+        "ALTER TABLE comments ADD COLUMN IF NOT EXISTS tsv tsvector",
+        _index("posts", "tsv", "gin"),
+        _index("comments", "tsv", "gin"),
+    ],
+    # 3: multi-index hashing substrings of the images inserted before imagehashchunks existed
+    [
+        _fill_hash_chunks,
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def _get_version(cur):
+    cur.execute("SELECT coalesce(max(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def get_version(db_file=DBFILE):
+    """ Version of the last migration applied to the database, 0 if none """
+    conn = psycopg2.connect(db_file)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                return 0
+            return _get_version(cur)
+    finally:
+        conn.close()
+
+
+def _drop_invalid_index(cur, statement):
+    """ A CREATE INDEX CONCURRENTLY that failed leaves an invalid index behind, which IF NOT EXISTS would keep """
+    match = re.search(r"IF NOT EXISTS (\w+)", statement)
+    if not match or "CONCURRENTLY" not in statement:
+        return
+    cur.execute("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (match.group(1),))
+    res = cur.fetchone()
+    if res and res[0]:
+        logger.warning("Dropping invalid index %s" % match.group(1))
+        cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % match.group(1))
+
+
+def migrate(db_file=DBFILE):
+    """ Applies the migrations the database does not have yet, returns the schema version """
+    conn = psycopg2.connect(db_file)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                        "version INTEGER PRIMARY KEY, applied TIMESTAMP NOT NULL DEFAULT now())")
+
+            version = _get_version(cur)
+            for version, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info("Applying schema migration %d" % version)
+                for statement in statements:
+                    if callable(statement):
+                        statement(db_file)
+                        continue
+                    _drop_invalid_index(cur, statement)
+                    cur.execute(statement)
+                cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (version,))
+
+            cur.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+        return version
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    # Creates missing tables first
+    from DB import DB
+    from rabbitmq_listen import SCHEMA
+
+    db_file = sys.argv[1] if len(sys.argv) > 1 else DBFILE
+    DB(db_file, **SCHEMA)
+    print("Schema version %d" % migrate(db_file))
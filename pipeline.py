@@ -0,0 +1,286 @@
+import binascii
+import json
+from collections import OrderedDict, namedtuple
+from functools import partial
+from queue import Queue
+from threading import Lock, Thread, get_ident, local
+from time import sleep, time
+
+from Httpy import Httpy
+from common import logger, PIPELINE_STAGES, PIPELINE_METRICS_INTERVAL
+from img_util import get_sha1, save_thumb
+from rabbitmq_listen import Consumer, arg_parser
+
+# An image or video url found in a post or comment
+MediaTask = namedtuple("MediaTask", ["url", "postid", "commentid", "albumid"])
+
+
+class Job:
+    """ Tasks spawned by one message. on_done(failed) is called once all of them are finished """
+
+    def __init__(self, on_done):
+        self.failed = False
+        self._on_done = on_done
+        # Released by the message worker once the message is parsed
+        self._pending = 1
+        self._lock = Lock()
+
+    def add(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            self._on_done(self.failed)
+
+
+class Stage:
+    """
+        Pool of worker threads consuming a bounded queue. fn(item, context) returns or yields the
+        (stage name, item) to pass on, putting them blocks while the next stage's queue is full.
+        * context - function of the stage returning the per-worker context, e.g. a Httpy
+    """
+
+    def __init__(self, name, fn, workers, queue_size, timeout, context=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.timeout = timeout
+        self.context = context
+        self.queue = Queue(maxsize=queue_size)
+
+        self.processed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self._busy_time = 0
+        self._blocked_time = 0
+        self._running = {}
+        self._lock = Lock()
+
+    def start(self, pipeline):
+        for i in range(self.workers):
+            Thread(target=self._work, args=(pipeline,), name="%s-%d" % (self.name, i), daemon=True).start()
+
+    def _work(self, pipeline):
+        context = self.context(self) if self.context else None
+        while True:
+            job, item = self.queue.get()
+            start = time()
+            with self._lock:
+                self._running[get_ident()] = start
+            blocked = 0
+            try:
+                for stage, next_item in self.fn(item, context) or ():
+                    put_start = time()
+                    pipeline.put(stage, job, next_item)
+                    blocked += time() - put_start
+            except TimeoutError:
+                logger.error("%s: timed out after %ds" % (self.name, self.timeout))
+                job.failed = True
+                with self._lock:
+                    self.timeouts += 1
+            except Exception as e:
+                logger.error(e)
+                job.failed = True
+                with self._lock:
+                    self.errors += 1
+            finally:
+                with self._lock:
+                    del self._running[get_ident()]
+                    self.processed += 1
+                    self._busy_time += time() - start - blocked
+                    self._blocked_time += blocked
+                job.release()
+
+    def _mean_ms(self, total):
+        return round(total / self.processed * 1000, 1) if self.processed else None
+
+    def metrics(self, now):
+        with self._lock:
+            return {
+                "queued": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "workers": self.workers,
+                "busy": len(self._running),
+                "overdue": sum(1 for start in self._running.values() if now - start > self.timeout),
+                "processed": self.processed,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                # Time spent working on a task, and waiting for room in the next stage's queue
+                "mean_ms": self._mean_ms(self._busy_time),
+                "mean_blocked_ms": self._mean_ms(self._blocked_time),
+            }
+
+
+class Pipeline:
+    """ Stages connected by bounded queues, the pipeline only stops accepting work when a queue is full """
+
+    def __init__(self, stages):
+        self.stages = OrderedDict((stage.name, stage) for stage in stages)
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def start(self, metrics_interval=PIPELINE_METRICS_INTERVAL):
+        for stage in self.stages.values():
+            stage.start(self)
+        if metrics_interval:
+            Thread(target=self._log_metrics, args=(metrics_interval,), daemon=True).start()
+
+    def put(self, stage, job, item):
+        job.add()
+        self.stages[stage].queue.put((job, item))
+
+    def metrics(self):
+        now = time()
+        return OrderedDict((name, stage.metrics(now)) for name, stage in self.stages.items())
+
+    def _log_metrics(self, interval):
+        while True:
+            sleep(interval)
+            metrics = self.metrics()
+            logger.info("Pipeline %s" % json.dumps(metrics))
+            for name, m in metrics.items():
+                if m["overdue"]:
+                    logger.warning("%s: %d tasks running for more than %ds" %
+                                   (name, m["overdue"], self[name].timeout))
+
+
+def _web(stage):
+    web = Httpy()
+    web.curl.setopt(web.curl.TIMEOUT, stage.timeout)
+    return web
+
+
+class PipelineConsumer(Consumer):
+    """
+        Consumer that processes urls in stages with their own workers:
+        resolve -> download -> dedupe (sha1) -> hash (decode, dhash, thumbnail encoding) -> persist -> thumbnail,
+        and resolve -> video. Message worker threads only write posts and comments, a message is acknowledged
+        once every task it spawned is finished, and rejected (retried once) if any of them failed.
+        * stages - {name: (workers, queue size, timeout)}
+    """
+
+    def __init__(self, stages=PIPELINE_STAGES, **kwargs):
+        super().__init__(**kwargs)
+        self._message = local()
+
+        def stage(name, fn, context=None):
+            return Stage(name, fn, *stages[name], context=context)
+
+        self.pipeline = Pipeline([
+            stage("resolve", self._resolve),
+            stage("download", self._download, context=_web),
+            stage("dedupe", self._dedupe),
+            stage("hash", self._hash),
+            stage("persist", self._persist),
+            stage("thumbnail", self._thumbnail),
+            stage("video", self._video, context=_web),
+        ])
+
+    def run(self):
+        self.pipeline.start()
+        super().run()
+
+    def _message_callback_worker(self):
+        logger.info("Started message callback worker")
+        web = Httpy()
+        while True:
+            delivery_tag, redelivered, body = self._q.get()
+            job = Job(partial(self._finish, delivery_tag, redelivered))
+            self._message.job = job
+            try:
+                self._message_callback(body, web)
+            except Exception as e:
+                logger.error(e)
+                job.failed = True
+            finally:
+                job.release()
+                self._q.task_done()
+
+    def _finish(self, delivery_tag, redelivered, failed):
+        if failed:
+            self._nack(delivery_tag, redelivered)
+        else:
+            self._ack(delivery_tag)
+
+    def parse_url(self, url, web, postid=None, commentid=None):
+        self.pipeline.put("resolve", self._message.job, MediaTask(url, postid, commentid, None))
+
+    def _resolve(self, task, _):
+        for kind, url, albumid in self.resolve_url(task.url):
+            yield ("download" if kind == "im" else "video"), task._replace(url=url, albumid=albumid)
+
+    def _download(self, task, web):
+        existing_by_url = self.db.get_image_from_url(task.url)
+        if existing_by_url:
+            self._link_image(task.url, existing_by_url, task.postid, task.commentid, task.albumid)
+            return
+        try:
+            image_buffer = web.download(task.url)
+        except Exception as e:
+            # Httpy reports curl errors as plain exceptions
+            if "timed out" in str(e):
+                raise TimeoutError(str(e))
+            raise
+        yield "dedupe", (task, image_buffer)
+
+    def _dedupe(self, item, _):
+        task, image_buffer = item
+        sha1 = get_sha1(image_buffer)
+        existing_by_sha1 = self.db.get_image_from_sha1(sha1)
+        if existing_by_sha1:
+            self._link_image(task.url, existing_by_sha1, task.postid, task.commentid, task.albumid)
+            return
+        yield "hash", (task, image_buffer, sha1)
+
+    def _hash(self, item, _):
+        task, image_buffer, sha1 = item
+        # Work submitted to the process pool can't be cancelled, a task running past the timeout is only overdue
+        info = self.cpu.process(image_buffer)
+        yield "persist", (task, info, len(image_buffer), sha1)
+
+    def _persist(self, item, _):
+        task, info, size, sha1 = item
+        imageid = self.db.insert_image(info.hash, info.width, info.height, size, sha1)
+        self.db.insert_imageurl(task.url, imageid=imageid, albumid=task.albumid, postid=task.postid,
+                                commentid=task.commentid)
+        if self.hash_matrix is not None:
+            self.hash_matrix.append(imageid, info.hash)
+
+        logger.info("(+) Image ID(%s) [%dx%s %dB] #%s" %
+                    (
+                        imageid, info.width, info.height, size,
+                        binascii.hexlify(info.hash).decode("ascii")
+                    ))
+        yield "thumbnail", (imageid, info.thumbnail)
+
+    def _thumbnail(self, item, _):
+        imageid, thumbnail = item
+        save_thumb(thumbnail, imageid)
+
+    def _video(self, task, web):
+        self.parse_video(task.url, web, postid=task.postid, commentid=task.commentid)
+
+
+if __name__ == '__main__':
+    parser = arg_parser()
+    parser.add_argument("--workers", action="append", default=[], metavar="STAGE=N",
+                        help="Worker threads of a stage (%s)" % ", ".join(PIPELINE_STAGES))
+    args = parser.parse_args()
+
+    stages = dict(PIPELINE_STAGES)
+    for option in args.workers:
+        name, workers = option.split("=")
+        stages[name] = (int(workers),) + stages[name][1:]
+
+    try:
+        consumer = PipelineConsumer(stages=stages, host=args.host, queue=args.queue, threads=args.threads,
+                                    prefetch=args.prefetch, cpu_workers=args.cpu_workers)
+        consumer.run()
+
+    except KeyboardInterrupt:
+        logger.error('Interrupted (^C)')
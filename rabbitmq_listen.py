@@ -1,7 +1,9 @@
+import argparse
 import binascii
 import json
 import os
 import sys
+from functools import partial
 from queue import Queue
 from subprocess import getstatusoutput
 from threading import Thread
@@ -10,10 +12,16 @@ import pika
 from youtube_dl import YoutubeDL
 
 from DB import DB
+from batch_writer import BatchWriter
 from Httpy import Httpy
-from common import logger, DBFILE
-from img_util import get_image_urls, create_thumb, image_from_buffer, get_sha1, get_hash, thumb_path
+from common import logger, DBFILE, IMAGE_INDEX, HASH_MATRIX_PATH, USE_REDIS, WRITE_BATCH_SIZE, \
+    RABBITMQ_HOST, CONSUMER_QUEUE, CONSUMER_THREADS, CONSUMER_PREFETCH, CPU_WORKERS
+from cpu_stage import CpuStage
+from hash_index import MmapHashIndex
+from migrations import get_version, SCHEMA_VERSION
+from img_util import get_image_urls, save_thumb, get_sha1, thumb_path
 from reddit import Post, Comment, COMMENT_FIELDS, POST_FIELDS
+from result_cache import ResultCache
 from util import is_image_direct_link, should_parse_link, is_video, load_list
 from video_util import info_from_video_buffer, flatten_video_info
 
@@ -34,7 +42,8 @@ SCHEMA = {
         'score     INTEGER, \n\t' +
         'created   INTEGER, \n\t' +  # Time in UTC
         'is_self   BOOLEAN, \n\t' +
-        'over_18   BOOLEAN',
+        'over_18   BOOLEAN, \n\t' +
+        'tsv       tsvector',  # Full-text search document of title and text
 
     'Comments':
         '\n\t' +
@@ -46,6 +55,7 @@ SCHEMA = {
         'ups     INTEGER, \n\t' +
         'downs   INTEGER, \n\t' +
         'created INTEGER, \n\t' +  # Time in UTC
+        'tsv     tsvector, \n\t' +  # Full-text search document of body
         'FOREIGN KEY(postid) REFERENCES posts(id)',
 
     'Images':
@@ -57,6 +67,15 @@ SCHEMA = {
         'height  INTEGER,     \n\t' +
         'bytes   INTEGER',
 
+    # Multi-index hashing substrings of images.hash, see hash_util.hash_chunks()
+    'ImageHashChunks':
+        '\n\t' +
+        'imageid INTEGER NOT NULL, \n\t' +
+        'chunk   SMALLINT NOT NULL, \n\t' +  # Substring position
+        'value   INTEGER NOT NULL, \n\t' +  # Substring value
+        'PRIMARY KEY(chunk, value, imageid), \n\t' +
+        'FOREIGN KEY(imageid) REFERENCES images(id)',
+
     'videos':
         '\n\t' +
         'id  SERIAL PRIMARY KEY, \n\t' +
@@ -112,14 +131,37 @@ SCHEMA = {
 
 class Consumer:
 
-    def __init__(self):
+    def __init__(self, host=RABBITMQ_HOST, queue=CONSUMER_QUEUE, threads=CONSUMER_THREADS,
+                 prefetch=CONSUMER_PREFETCH, cpu_workers=CPU_WORKERS):
         self.db = DB(DBFILE, **SCHEMA)
+        # Prepared inserts write columns added by the migrations
+        version = get_version(DBFILE)
+        if version < SCHEMA_VERSION:
+            logger.error("Database schema version is %d, expected %d: run migrations.py first" %
+                         (version, SCHEMA_VERSION))
+            sys.exit(1)
+        if WRITE_BATCH_SIZE:
+            self.db = BatchWriter(self.db)
         self.web = Httpy()
-        self._rabbitmq = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
+        self.cpu = CpuStage(cpu_workers)
+        self.threads = threads
+        self._rabbitmq = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        self._declare_queue(queue, prefetch)
+        self.hash_matrix = MmapHashIndex(HASH_MATRIX_PATH) if IMAGE_INDEX == "mmap" else None
+        # Only used to invalidate the search results cached in redis
+        self.result_cache = ResultCache(max_bytes=0) if USE_REDIS else None
+
+    def _declare_queue(self, queue, prefetch):
         self._rabbitmq_channel = self._rabbitmq.channel()
         self._rabbitmq_channel.exchange_declare(exchange='reddit', exchange_type='topic')
-        self._rabbitmq_queue = self._rabbitmq_channel.queue_declare('', exclusive=True)
-        self._q = Queue()
+        if queue:
+            self._rabbitmq_queue = self._rabbitmq_channel.queue_declare(queue, durable=True)
+        else:
+            self._rabbitmq_queue = self._rabbitmq_channel.queue_declare('', exclusive=True)
+        # The broker stops delivering when prefetch messages are unacknowledged, so the buffer
+        # never fills up and put() never blocks the connection's thread
+        self._rabbitmq_channel.basic_qos(prefetch_count=prefetch)
+        self._q = Queue(maxsize=prefetch)
 
     def run(self):
         for sub in load_list("subs.txt"):
@@ -128,13 +170,14 @@ class Consumer:
                                               routing_key="*.%s" % sub)
 
         def msg_callback(ch, method, properties, body):
-            self._q.put(body)
+            self._q.put((method.delivery_tag, method.redelivered, body))
 
         self._rabbitmq_channel.basic_consume(queue=self._rabbitmq_queue.method.queue,
                                              on_message_callback=msg_callback,
-                                             auto_ack=True)
-        for _ in range(0, 30):
-            t = Thread(target=self._message_callback_worker)
+                                             auto_ack=False)
+        for _ in range(0, self.threads):
+            # Messages in progress are not acknowledged, the broker redelivers them if the process exits
+            t = Thread(target=self._message_callback_worker, daemon=True)
             t.start()
         self._rabbitmq_channel.start_consuming()
 
@@ -152,14 +195,34 @@ class Consumer:
         logger.info("Started message callback worker")
         web = Httpy()
         while True:
+            delivery_tag, redelivered, body = self._q.get()
             try:
-                body = self._q.get()
                 self._message_callback(body, web)
+                self._ack(delivery_tag)
             except Exception as e:
                 logger.error(e)
+                self._nack(delivery_tag, redelivered)
             finally:
                 self._q.task_done()
 
+    def _ack(self, delivery_tag):
+        # pika channels are not thread safe, acks are sent from the connection's thread
+        self._rabbitmq.add_callback_threadsafe(partial(self._rabbitmq_channel.basic_ack, delivery_tag=delivery_tag))
+
+    def _nack(self, delivery_tag, redelivered):
+        # Retried once, a message that fails again is dropped
+        self._rabbitmq.add_callback_threadsafe(
+            partial(self._rabbitmq_channel.basic_nack, delivery_tag=delivery_tag, requeue=not redelivered))
+
+    def _invalidate_results(self, kind, item_id):
+        if self.result_cache is not None:
+            self.result_cache.invalidate(kind, item_id)
+
+    def _link_image(self, url, imageid, postid, commentid, albumid):
+        """ Adds an url of an image already in the database """
+        self.db.insert_imageurl(url=url, imageid=imageid, postid=postid, commentid=commentid, albumid=albumid)
+        self._invalidate_results("im", imageid)
+
     def parse_post(self, post, web):
         # Add post to database
         postid_db = self.db.insert_post(post.id, post.title, post.url, post.selftext,
@@ -168,8 +231,12 @@ class Consumer:
                                         int(post.created_utc), post.is_self, post.over_18)
 
         if postid_db is None:
-            logger.debug('Ignoring post (already indexed)')
-            return False
+            # Already indexed, possibly by a delivery of this message that did not finish: urls that were
+            # already parsed are found by get_image_from_url
+            existing = self.db.get_postid_from_hexid(post.id)
+            if not existing:
+                return False
+            postid_db = existing[0]
 
         for url in post.urls:
             self.parse_url(url, web, postid=postid_db)
@@ -182,19 +249,19 @@ class Consumer:
                 return
             comid_db = self.db.insert_comment(postid, comment.id, comment.author,
                                               comment.body, comment.ups, comment.downs, comment.created_utc)
+            if comid_db is None:
+                comid_db = self.db.get_commentid_from_hexid(comment.id)
             for url in comment.urls:
                 self.parse_url(url, web, postid=postid, commentid=comid_db)
 
-    def parse_url(self, url, web, postid=None, commentid=None):
-        """ Gets image hash(es) from URL, populates database """
+    def resolve_url(self, url):
+        """ Returns the [(kind, url, albumid)] of the images ("im") and videos ("vid") an URL links to """
 
         if is_image_direct_link(url):
-            self.parse_image(url, web, postid=postid, commentid=commentid, albumid=None)
-            return True
+            return [("im", url, None)]
 
         if is_video(url):
-            self.parse_video(url, web, postid=postid, commentid=commentid)
-            return True
+            return [("vid", url, None)]
 
         if "v.redd.it" in url:
             logger.debug("Using youtube-dl to get reddit video url")
@@ -202,11 +269,10 @@ class Consumer:
             info = ytdl.extract_info(url, download=False, process=False)
 
             best = max(info["formats"], key=lambda x: x["width"] if "width" in x and x["width"] else 0)
-            self.parse_video(best["url"], web, postid=postid, commentid=commentid)
-            return
+            return [("vid", best["url"], None)]
 
         if not should_parse_link(url):
-            return
+            return []
 
         image_urls = get_image_urls(url)
 
@@ -215,18 +281,27 @@ class Consumer:
         if len(image_urls) > 1:
             albumid = self.db.get_or_create_album(url)  # TODO: fix url len thing
 
+        media = []
         for image_url in image_urls:
             if is_image_direct_link(image_url):
-                self.parse_image(image_url, web, postid=postid, commentid=commentid, albumid=albumid)
+                media.append(("im", image_url, albumid))
             elif is_video(image_url):
-                self.parse_video(image_url, web, postid=postid, commentid=commentid)
-        return True
+                media.append(("vid", image_url, None))
+        return media
+
+    def parse_url(self, url, web, postid=None, commentid=None):
+        """ Gets image hash(es) from URL, populates database """
+
+        for kind, media_url, albumid in self.resolve_url(url):
+            if kind == "im":
+                self.parse_image(media_url, web, postid=postid, commentid=commentid, albumid=albumid)
+            else:
+                self.parse_video(media_url, web, postid=postid, commentid=commentid)
 
     def parse_image(self, url, web, postid=None, commentid=None, albumid=None):
         existing_by_url = self.db.get_image_from_url(url)
         if existing_by_url:
-            self.db.insert_imageurl(url=url, imageid=existing_by_url, postid=postid, commentid=commentid,
-                                    albumid=albumid)
+            self._link_image(url, existing_by_url, postid, commentid, albumid)
             return
 
         try:
@@ -235,20 +310,19 @@ class Consumer:
             sha1 = get_sha1(image_buffer)
             existing_by_sha1 = self.db.get_image_from_sha1(sha1)
             if existing_by_sha1:
-                self.db.insert_imageurl(url=url, imageid=existing_by_sha1, postid=postid, commentid=commentid,
-                                        albumid=albumid)
+                self._link_image(url, existing_by_sha1, postid, commentid, albumid)
                 return
 
-            im = image_from_buffer(image_buffer)
-            imhash = get_hash(im)
-            width, height = im.size
+            info = self.cpu.process(image_buffer)
+            imhash, width, height = info.hash, info.width, info.height
             size = len(image_buffer)
+            del image_buffer
 
             imageid = self.db.insert_image(imhash, width, height, size, sha1)
             self.db.insert_imageurl(url, imageid=imageid, albumid=albumid, postid=postid, commentid=commentid)
-            create_thumb(im, imageid)
-            del im
-            del image_buffer
+            if self.hash_matrix is not None:
+                self.hash_matrix.append(imageid, imhash)
+            save_thumb(info.thumbnail, imageid)
 
             logger.info("(+) Image ID(%s) [%dx%s %dB] #%s" %
                         (
@@ -262,6 +336,7 @@ class Consumer:
         existing_by_url = self.db.get_video_from_url(url)
         if existing_by_url:
             self.db.insert_videourl(url=url, video_id=existing_by_url, postid=postid, commentid=commentid)
+            self._invalidate_results("vid", existing_by_url)
             return
 
         try:
@@ -277,6 +352,7 @@ class Consumer:
         existing_by_sha1 = self.db.get_video_from_sha1(sha1)
         if existing_by_sha1:
             self.db.insert_videourl(url=url, video_id=existing_by_sha1, postid=postid, commentid=commentid)
+            self._invalidate_results("vid", existing_by_sha1)
             return
 
         frames, info = info_from_video_buffer(video_buffer, url[url.rfind(".") + 1:].replace("gifv", "mp4"))
@@ -301,9 +377,22 @@ class Consumer:
                      len(video_buffer), len(frames)))
 
 
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=RABBITMQ_HOST, help="RabbitMQ host")
+    parser.add_argument("--queue", default=CONSUMER_QUEUE,
+                        help="Shared durable queue, consumers using the same name split the work")
+    parser.add_argument("--threads", type=int, default=CONSUMER_THREADS, help="Worker threads")
+    parser.add_argument("--prefetch", type=int, default=CONSUMER_PREFETCH, help="Unacknowledged messages")
+    parser.add_argument("--cpu-workers", type=int, default=CPU_WORKERS, help="Image processing processes")
+    return parser
+
+
 if __name__ == '__main__':
+    args = arg_parser().parse_args()
+
     try:
-        consumer = Consumer()
+        consumer = Consumer(args.host, args.queue, args.threads, args.prefetch, args.cpu_workers)
         consumer.run()
 
     except KeyboardInterrupt:
@@ -0,0 +1,124 @@
+import pickle
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import time, sleep
+
+from common import logger, USE_REDIS, REDIS_HOST, REDIS_PORT, RESULT_CACHE_TTL, RESULT_CACHE_LOCAL_TTL
+
+if USE_REDIS:
+    import redis
+
+INVALIDATE_CHANNEL = "ir:results:invalidate"
+
+
+class ResultCache:
+    """
+        LRU cache of the rows that hydrate the search results of an image or video, keyed by
+        (kind, id) where kind is "im" or "vid". Rows rather than result objects are cached because
+        hits carry per-query values (e.g. distance).
+        Local entries are capped at max_bytes (pickled size). With USE_REDIS, misses are also looked up
+        in redis and invalidations are broadcast to every process. Without it, nothing tells this process
+        that the consumer added urls to an image, so local entries expire after RESULT_CACHE_LOCAL_TTL.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (rows, size, expires)
+        self._size = 0
+        self._lock = Lock()
+
+        self._redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT) if USE_REDIS else None
+        self._local_ttl = RESULT_CACHE_TTL if self._redis is not None else RESULT_CACHE_LOCAL_TTL
+        if self._redis is not None and max_bytes > 0:
+            Thread(target=self._listen, daemon=True).start()
+
+    @staticmethod
+    def _key(kind, item_id):
+        return "ir:results:%s:%d" % (kind, item_id)
+
+    def get_many(self, kind, ids):
+        """ Returns {id: rows} for the ids in cache """
+        found = {}
+        now = time()
+        with self._lock:
+            for item_id in ids:
+                key = self._key(kind, item_id)
+                entry = self._entries.get(key)
+                if entry is not None and entry[2] > now:
+                    self._entries.move_to_end(key)
+                    found[item_id] = entry[0]
+
+        missing = [item_id for item_id in ids if item_id not in found]
+        if self._redis is not None and missing:
+            try:
+                values = self._redis.mget([self._key(kind, item_id) for item_id in missing])
+            except redis.RedisError as e:
+                logger.warning("Could not read result cache: %s" % (e, ))
+                return found
+
+            for item_id, value in zip(missing, values):
+                if value is not None:
+                    found[item_id] = pickle.loads(value)
+                    self._put_local(self._key(kind, item_id), found[item_id], len(value))
+        return found
+
+    def put_many(self, kind, rows_by_id):
+        pipe = self._redis.pipeline(transaction=False) if self._redis is not None else None
+        for item_id, rows in rows_by_id.items():
+            key = self._key(kind, item_id)
+            value = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+            self._put_local(key, rows, len(value))
+            if pipe is not None:
+                pipe.set(key, value, ex=RESULT_CACHE_TTL)
+
+        if pipe is not None and rows_by_id:
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning("Could not write result cache: %s" % (e, ))
+
+    def _put_local(self, key, rows, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (rows, size, time() + self._local_ttl)
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def _evict_local(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def invalidate(self, kind, item_id):
+        """ Drops an entry from this process, redis and (through redis) every other process """
+        key = self._key(kind, item_id)
+        self._evict_local(key)
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+                self._redis.publish(INVALIDATE_CHANNEL, key)
+            except redis.RedisError as e:
+                logger.warning("Could not invalidate %s: %s" % (key, e))
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                for message in pubsub.listen():
+                    self._evict_local(message["data"].decode())
+            except redis.RedisError as e:
+                # Entries invalidated while disconnected could be stale
+                logger.warning("Lost result cache invalidation channel: %s" % (e, ))
+                with self._lock:
+                    self._entries.clear()
+                    self._size = 0
+                sleep(1)
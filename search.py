@@ -1,36 +1,68 @@
 import json
 import os
-import re
 from os import path
 
 from flask import Blueprint, Response, request
 
-from DB import DB
+from DB import DB, CommentSearchResult, ImageItem
 from Httpy import Httpy
-from common import DBFILE, cache
+from common import DBFILE, DBFILE_READ, cache, IMAGE_INDEX, VIDEO_INDEX, SHARD_SOCKETS, RESULT_CACHE_SIZE
+from hash_index import load_image_index, load_video_index, start_refresh_thread
 from img_util import thumb_path, image_from_buffer, get_hash
+from result_cache import ResultCache
+from shard import ShardClient
 from util import clean_url, is_user_valid
 from video_util import info_from_video_buffer
 
 search_page = Blueprint('search', __name__, template_folder='templates')
 
-AlphaNum = re.compile(r'[\W_]+')
 MAX_DISTANCE = 30
 
 MAX_FRAME_COUNT = 30
 DEFAULT_FRAME_COUNT = 10
 
-db = DB(DBFILE)
+# Image searches return pages of k hits, the next pages are selected after the (distance, id) of the last hit
+MAX_K = 1000
+DEFAULT_K = 100
+# Deepest hit reachable with a page number instead of a cursor
+MAX_PAGE_OFFSET = 10000
+
+PAGE_SIZE = 100
+
+MAX_TEXT_LENGTH = 200
+
+# Column names of the rows of the compact response format
+COMPACT_COLUMNS = {
+    "hits": ["type", "hexid", "item_type", "item_id", "url", "album_url"],
+    "posts": ["title", "text", "comments", "permalink", "subreddit", "created", "ups", "downs", "author"],
+    "comments": ["body", "post_id", "permalink", "subreddit", "created", "ups", "downs", "author"],
+    "images": ["width", "height", "size", "sha1", "thumb", "distance"],
+    "videos": ["width", "height", "size", "sha1", "bitrate", "codec", "format", "duration", "frames",
+               "matched_frames"],
+}
+
+db = DB(DBFILE, result_cache=ResultCache(RESULT_CACHE_SIZE) if RESULT_CACHE_SIZE else None,
+        read_db_file=DBFILE_READ)
+
+shards = ShardClient(SHARD_SOCKETS) if SHARD_SOCKETS else None
+
+index_db = DB(DBFILE, read_db_file=DBFILE_READ) if (IMAGE_INDEX or VIDEO_INDEX) and not shards else None
+image_index = load_image_index(index_db, IMAGE_INDEX) if index_db and IMAGE_INDEX else None
+video_index = load_video_index(index_db) if index_db and VIDEO_INDEX else None
+if index_db is not None:
+    start_refresh_thread(index_db, image_index, video_index)
 
 
 class SearchResults:
-    __slots__ = "url", "hits", "error", "result_count"
+    __slots__ = "url", "hits", "error", "result_count", "partial", "next"
 
-    def __init__(self, hits, error=None, url=""):
+    def __init__(self, hits, error=None, url="", partial=False, next=None):
         self.url = url
         self.hits = hits
         self.error = error
         self.result_count = len(hits)
+        self.partial = partial
+        self.next = next
 
     def json(self):
 
@@ -38,18 +70,140 @@ class SearchResults:
             "hits": [h.json() for h in self.hits],
             "error": self.error,
             "url": self.url,
-            "result_count": self.result_count
-        })
+            "result_count": self.result_count,
+            "partial": self.partial,
+            "next": self.next,
+        }, check_circular=False)
+
+    def compact_json(self):
+        """
+            Posts, comments, images and videos are serialized once, in tables keyed by id,
+            and every hit is a row of references. Rows are lists, see COMPACT_COLUMNS
+        """
+        posts = {}
+        comments = {}
+        images = {}
+        videos = {}
+        hits = []
+
+        for h in self.hits:
+            if isinstance(h, CommentSearchResult):
+                if h.hexid not in comments:
+                    comments[h.hexid] = [h.body, h.post_id, h.permalink, h.subreddit, h.created,
+                                         h.ups, h.downs, h.author]
+                hit = ["comment", h.hexid]
+            else:
+                if h.hexid not in posts:
+                    posts[h.hexid] = [h.title, h.text, h.comments, h.permalink, h.subreddit, h.created,
+                                      h.ups, h.downs, h.author]
+                hit = ["post", h.hexid]
+
+            item = h.item
+            if isinstance(item, ImageItem):
+                if item.image_id not in images:
+                    images[item.image_id] = [item.width, item.height, item.size, item.sha1, item.thumb,
+                                             item.distance]
+                hit.extend(("image", item.image_id, item.url, item.album_url))
+            else:
+                if item.video_id not in videos:
+                    videos[item.video_id] = [item.width, item.height, item.size, item.sha1, item.bitrate,
+                                             item.codec, item.format, item.duration, item.frames,
+                                             item.matched_frames]
+                hit.extend(("video", item.video_id, item.url, None))
+            hits.append(hit)
+
+        return json.dumps({
+            "columns": COMPACT_COLUMNS,
+            "hits": hits,
+            "posts": posts,
+            "comments": comments,
+            "images": images,
+            "videos": videos,
+            "error": self.error,
+            "url": self.url,
+            "result_count": self.result_count,
+            "partial": self.partial,
+            "next": self.next,
+        }, separators=(",", ":"), check_circular=False)
+
+
+def get_similar_images(hash, distance, k, after=None):
+    """
+        Returns (up to k (image id, distance) tuples ordered by (distance, image id),
+        whether some shards did not answer)
+        * after - optional (distance, image id) cursor, only images ordered after it are returned
+    """
+    if shards is not None:
+        images, failed = shards.get_similar_images(hash, distance, k, after)
+        return images, failed > 0
+    if image_index is not None:
+        return image_index.nearest(hash, k, distance, after), False
+    return db.get_similar_images(hash, distance=distance, k=k, after=after), False
+
+
+def get_similar_videos(hashes, distance, frame_count, k):
+    """ Returns (up to k (video id, matched frame count) tuples, whether some shards did not answer) """
+    if shards is not None:
+        videos, failed = shards.get_similar_videos(list(hashes), distance, frame_count, k)
+        return videos, failed > 0
+    if video_index is not None:
+        return video_index.search(hashes, distance, frame_count, k), False
+    return db.get_similar_videos_by_hash(hashes, distance, frame_count, k), False
+
+
+def parse_cursor(cursor):
+    """ "<distance>:<image id>" or "<image id>" -> tuple of ints """
+    try:
+        return tuple(int(x) for x in cursor.split(":"))
+    except ValueError:
+        raise Exception("Invalid cursor: '%s'" % cursor)
+
+
+def similar_images_page(hash, distance, k, after, page):
+    """
+        Selects a page of k (image id, distance) tuples, ordered by (distance, image id). The page after
+        a cursor is selected by the index or the database, one more hit is read to know if there is a next page.
+        Returns (page, cursor of the next page, whether some shards did not answer)
+    """
+    if after:
+        after = parse_cursor(after)
+        if len(after) != 2:
+            raise Exception("Invalid cursor: '%s'" % ":".join(map(str, after)))
+        start = 0
+    else:
+        start = page * k
+        if start > MAX_PAGE_OFFSET:
+            raise Exception("Page too deep, use the 'after' cursor")
+
+    images, partial = get_similar_images(hash, distance, start + k + 1, after)
+    selected = images[start:start + k]
+    if len(images) > start + k:
+        return selected, "%d:%d" % (selected[-1][1], selected[-1][0]), partial
+    return selected, None, partial
+
+
+def ndjson_results(images, distances, next_cursor, partial):
+    """ One hit per line, followed by an "end" line """
+    for result in db.iter_result_for_images(images, distances):
+        yield json.dumps(result.json()) + "\n"
+    yield json.dumps({"type": "end", "next": next_cursor, "partial": partial}) + "\n"
+
 
+def results_response(results, compact=False):
+    return Response(results.compact_json() if compact else results.json(), mimetype="application/json")
 
-def build_results_for_images(images):
-    results = db.build_result_for_images(images)
 
-    return SearchResults(results)
+def image_results_response(images, distances=None, next_cursor=None, partial=False, stream=False,
+                           compact=False):
+    if stream:
+        return Response(ndjson_results(images, distances, next_cursor, partial), mimetype="application/x-ndjson")
+
+    results = SearchResults(db.build_result_for_images(images, distances), partial=partial, next=next_cursor)
+    return results_response(results, compact)
 
 
 @search_page.route("/search")
-@cache.cached(timeout=3600 * 24, query_string=True)
+@cache.cached(timeout=3600 * 24, query_string=True, unless=lambda: request.args.get("format") == "ndjson")
 def search():
     """ Searches for a single URL, prints results """
 
@@ -70,17 +224,40 @@ def search():
         else:
             frame_count = DEFAULT_FRAME_COUNT
 
+        if "k" in request.args:
+            try:
+                k = max(min(int(request.args["k"]), MAX_K), 1)
+            except:
+                k = DEFAULT_K
+        else:
+            k = DEFAULT_K
+
+        if "page" in request.args:
+            try:
+                page = max(int(request.args["page"]), 0)
+            except:
+                page = 0
+        else:
+            page = 0
+
+        after = request.args.get("after")
+        stream = request.args.get("format") == "ndjson"
+        compact = request.args.get("format") == "compact"
+
         if "img" in request.args:
-            return search_img_url(request.args["img"], distance)
+            return search_img_url(request.args["img"], distance, k, after, page, stream, compact)
 
         if "vid" in request.args:
-            return search_vid_url(request.args["vid"], distance, frame_count)
+            return search_vid_url(request.args["vid"], distance, frame_count, k, compact)
 
         if "album" in request.args:
             return search_album(request.args["album"])
 
         if "user" in request.args:
-            return search_user(request.args["user"])
+            return search_user(request.args["user"], after, page, stream, compact)
+
+        if "text" in request.args:
+            return search_text(request.args["text"], after, page, stream, compact)
     except Exception as e:
         return Response(json.dumps({'error': str(e)}), mimetype="application/json")
 
@@ -89,12 +266,9 @@ def search():
     # if "reddit" in request.args:
     #     return search_reddit(request.args["reddit"])
 
-    # if "text" in request.args:
-    #     return search_text(request.args["text"])
 
 
-
-def search_vid_url(query, distance, frame_count):
+def search_vid_url(query, distance, frame_count, k, compact=False):
     if ' ' in query:
         query = query.replace(' ', '%20')
 
@@ -113,19 +287,19 @@ def search_vid_url(query, distance, frame_count):
             except:
                 raise Exception("Could not identify video")
 
-            videos = db.get_similar_videos_by_hash(frames, distance, frame_count)
+            videos, partial = get_similar_videos(frames, distance, frame_count, k)
 
         else:
 
             hashes = db.get_video_hashes(video_id)
-            videos = db.get_similar_videos_by_hash(hashes, distance, frame_count)
+            videos, partial = get_similar_videos(hashes, distance, frame_count, k)
 
-        results = SearchResults(db.build_results_for_videos(videos))
+        results = SearchResults(db.build_results_for_videos(videos, dict(videos)), partial=partial)
 
     except Exception as e:
         return Response(json.dumps({'error': str(e)}), mimetype="application/json")
 
-    return Response(results.json(), mimetype="application/json")
+    return results_response(results, compact)
 
 
 def is_valid_url(url):
@@ -134,7 +308,7 @@ def is_valid_url(url):
     return True
 
 
-def search_img_url(query, distance):
+def search_img_url(query, distance, k, after=None, page=0, stream=False, compact=False):
     if ' ' in query:
         query = query.replace(' ', '%20')
 
@@ -158,14 +332,14 @@ def search_img_url(query, distance):
             except:
                 raise Exception("Could not identify image")
 
-        images = db.get_similar_images(hash, distance=distance)
-        results = build_results_for_images(images)
+        images, next_cursor, partial = similar_images_page(hash, distance, k, after, page)
+        distances = dict(images)
+
+        return image_results_response(images, distances, next_cursor, partial, stream, compact)
 
     except Exception as e:
         return Response(json.dumps({'error': str(e)}), mimetype="application/json")
 
-    return Response(results.json(), mimetype="application/json")
-
 
 # TODO update
 def search_reddit(reddit_id):
@@ -180,15 +354,22 @@ def search_reddit(reddit_id):
     }), mimetype="application/json")
 
 
-def search_user(user):
+def search_user(user, after=None, page=0, stream=False, compact=False):
     """ Returns posts/comments by a reddit user """
     if user.strip() == '' or not is_user_valid(user):
         raise Exception('invalid username')
 
-    images = db.get_images_from_author(author=user)
-    results = build_results_for_images(images)
+    if after:
+        images = db.get_images_from_author(author=user, after=parse_cursor(after)[0], limit=PAGE_SIZE + 1)
+    else:
+        images = db.get_images_from_author(author=user, offset=page * PAGE_SIZE, limit=PAGE_SIZE + 1)
 
-    return Response(results.json(), mimetype="application/json")
+    next_cursor = None
+    if len(images) > PAGE_SIZE:
+        images = images[:PAGE_SIZE]
+        next_cursor = str(images[-1][0])
+
+    return image_results_response(images, next_cursor=next_cursor, stream=stream, compact=compact)
 
 
 def search_album(url):
@@ -219,16 +400,21 @@ def search_album(url):
     }), mimetype="application/json")
 
 
-# TODO update (FULLTEXT please!)
-def search_text(text):
-    """ Prints posts/comments containing text in title/body. """
-    text = AlphaNum.sub('', text)
-    images = db.get_images_from_text(text)
+def search_text(text, after=None, page=0, stream=False, compact=False):
+    """ Returns images of posts/comments matching text in title/body, by relevance.
+     The cursor of the next page is its page number """
+    text = text.strip()[:MAX_TEXT_LENGTH]
+    if not text:
+        raise Exception('empty text query')
 
-    comments, posts = db.build_result_for_images(images)
+    if after:
+        page = parse_cursor(after)[0]
 
-    return Response(json.dumps({
-        'url': 'text:%s' % text,
-        'posts': posts,
-        'comments': comments
-    }), mimetype="application/json")
+    images = db.get_images_from_text(text, offset=page * PAGE_SIZE, limit=PAGE_SIZE + 1)
+
+    next_cursor = None
+    if len(images) > PAGE_SIZE:
+        images = images[:PAGE_SIZE]
+        next_cursor = str(page + 1)
+
+    return image_results_response(images, next_cursor=next_cursor, stream=stream, compact=compact)
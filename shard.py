@@ -0,0 +1,181 @@
+import binascii
+import heapq
+import json
+import os
+import selectors
+import socket
+import sys
+from operator import itemgetter
+from time import monotonic
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+
+from DB import DB
+from common import logger, DBFILE, DBFILE_READ, SHARD_TIMEOUT
+from hash_index import load_image_index, load_video_index, start_refresh_thread
+
+# Shard workers each hold the images and videos where id % shard count = shard, and answer
+# queries over a unix socket. Protocol: one JSON object per line in both directions.
+#   {"type": "image", "hash": <hex>, "distance": d, "k": k, "after": [distance, id] or null}
+#   {"type": "video", "hashes": [<hex>, ...], "distance": d, "frame_count": f, "k": k}
+#   -> {"hits": [[id, distance or matched frame count], ...]} or {"error": <message>}
+
+
+class ShardServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+    # Every search connects to every shard, connections beyond the listen backlog would be refused
+    request_queue_size = 128
+
+    def __init__(self, socket_path, image_index, video_index):
+        self.image_index = image_index
+        self.video_index = video_index
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, ShardRequestHandler)
+
+
+class ShardRequestHandler(StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                hits = self._search(json.loads(line))
+                response = {"hits": hits}
+            except Exception as e:
+                logger.error("Shard query failed: %s" % (e, ))
+                response = {"error": str(e)}
+
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+    def _search(self, query):
+        if query["type"] == "image":
+            after = query.get("after")
+            return self.server.image_index.nearest(binascii.unhexlify(query["hash"]), query["k"], query["distance"],
+                                                   tuple(after) if after else None)
+        if query["type"] == "video":
+            return self.server.video_index.search([binascii.unhexlify(h) for h in query["hashes"]],
+                                                  query["distance"], query["frame_count"], query["k"])
+        raise ValueError("Unknown query type %s" % query["type"])
+
+
+class ShardClient:
+    """
+        Scatters queries to every shard worker and merges their top-k hits.
+        Shards that fail or time out are left out of the results instead of failing the search.
+        Every query opens its own connections and waits for them with a selector in the calling thread,
+        so concurrent searches don't wait for each other and the timeout only covers the shards' answers.
+    """
+
+    def __init__(self, socket_paths, timeout=SHARD_TIMEOUT):
+        self.socket_paths = socket_paths
+        self.timeout = timeout
+
+    def _connect(self, socket_path, request):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self.timeout)
+            s.connect(socket_path)
+            s.sendall(request)
+            s.setblocking(False)
+        except:
+            s.close()
+            raise
+        return s
+
+    @staticmethod
+    def _parse(response):
+        response = json.loads(response)
+        if "error" in response:
+            raise Exception(response["error"])
+        return [tuple(hit) for hit in response["hits"]]
+
+    def _scatter(self, query):
+        """ Returns (hits of every shard that answered, number of shards that did not) """
+        deadline = monotonic() + self.timeout
+        request = json.dumps(query).encode() + b"\n"
+
+        hits = []
+        failed = 0
+        with selectors.DefaultSelector() as selector:
+            for path in self.socket_paths:
+                try:
+                    selector.register(self._connect(path, request), selectors.EVENT_READ, (path, bytearray()))
+                except OSError as e:
+                    logger.warning("Shard %s did not answer: %s" % (path, e))
+                    failed += 1
+
+            try:
+                while selector.get_map():
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    for key, _ in selector.select(remaining):
+                        path, buffer = key.data
+                        try:
+                            data = key.fileobj.recv(65536)
+                            if not data:
+                                raise ConnectionError("connection closed")
+                            buffer.extend(data)
+                            if not buffer.endswith(b"\n"):
+                                continue
+                            hits.extend(self._parse(buffer))
+                        except Exception as e:
+                            logger.warning("Shard %s did not answer: %s" % (path, e))
+                            failed += 1
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+            finally:
+                for key in list(selector.get_map().values()):
+                    logger.warning("Shard %s did not answer: timeout" % key.data[0])
+                    failed += 1
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+        return hits, failed
+
+    def get_similar_images(self, hash, distance, k, after=None):
+        """
+            Returns (up to k (image id, distance) tuples ordered by (distance, id), number of failed shards)
+            * after - optional (distance, id) cursor, only images ordered after it are returned
+        """
+        hits, failed = self._scatter({
+            "type": "image",
+            "hash": binascii.hexlify(hash).decode("ascii"),
+            "distance": distance,
+            "k": k,
+            "after": after,
+        })
+        return heapq.nsmallest(k, hits, key=lambda hit: (hit[1], hit[0])), failed
+
+    def get_similar_videos(self, hashes, distance, frame_count, k):
+        """ Returns (up to k (video id, matched frame count) tuples, number of failed shards) """
+        hits, failed = self._scatter({
+            "type": "video",
+            "hashes": [binascii.hexlify(h).decode("ascii") for h in hashes],
+            "distance": distance,
+            "frame_count": frame_count,
+            "k": k,
+        })
+        return heapq.nlargest(k, hits, key=itemgetter(1)), failed
+
+
+def run_shard(shard, shard_count, socket_path):
+    db = DB(DBFILE, read_db_file=DBFILE_READ)
+    image_index = load_image_index(db, "bktree", shard=(shard, shard_count))
+    video_index = load_video_index(db, shard=(shard, shard_count))
+    start_refresh_thread(db, image_index, video_index)
+
+    server = ShardServer(socket_path, image_index, video_index)
+    logger.info("Shard %d/%d listening on %s" % (shard, shard_count, socket_path))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print("usage: python shard.py <shard> <shard count> <socket path>")
+        sys.exit(1)
+
+    try:
+        run_shard(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3])
+    except KeyboardInterrupt:
+        logger.error('Interrupted (^C)')
@@ -137,10 +137,16 @@ function get_status() {
                 const resp = JSON.parse(request.responseText)["status"];
                 gebi("db_images").innerText = number_commas(resp['images']);
                 gebi("db_posts").innerText = number_commas(resp['posts']);
+                gebi("db_imageurls").innerText = number_commas(resp['imageurls']);
                 gebi("db_videos").innerText = number_commas(resp['videos']);
+                gebi("db_video_frames").innerText = number_commas(resp['video_frames']);
                 gebi("db_comments").innerText = number_commas(resp['comments']);
                 gebi("db_albums").innerText = number_commas(resp['albums']);
                 gebi("db_subreddits").innerText = number_commas(resp['subreddits']);
+                gebi("db_images_rate").innerText =
+                    number_commas(resp['images_last_minute']) + " / " + number_commas(resp['images_last_hour']);
+                gebi("db_posts_rate").innerText =
+                    number_commas(resp['posts_last_minute']) + " / " + number_commas(resp['posts_last_hour']);
             }
         }
     }
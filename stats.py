@@ -0,0 +1,73 @@
+from collections import deque
+from threading import Lock, Thread
+from time import sleep, time
+
+from common import logger, STATS_REFRESH_INTERVAL
+from util import load_list
+
+MINUTE = 60
+HOUR = 3600
+
+
+class StatsService:
+    """
+        Serves the /status counters from memory. They are computed with a single query every
+        interval seconds by a background thread.
+        Ingest rates are derived from the image/post insert counters sampled over the last hour.
+    """
+
+    def __init__(self, db, interval=STATS_REFRESH_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self._samples = deque()  # (time, images inserted, posts inserted)
+        self._stats = {}
+        self._lock = Lock()
+
+        self.refresh()
+        Thread(target=self._run, daemon=True).start()
+
+    def get(self):
+        with self._lock:
+            return self._stats
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Could not refresh stats: %s" % (e, ))
+
+    def refresh(self):
+        counts, images_inserted, posts_inserted = self.db.get_stats()
+        now = time()
+
+        self._samples.append((now, images_inserted, posts_inserted))
+        while self._samples[0][0] < now - HOUR:
+            self._samples.popleft()
+
+        stats = {
+            "posts": counts["posts"],
+            "comments": counts["comments"],
+            "images": counts["images"],
+            "imageurls": counts["imageurls"],
+            "albums": counts["albums"],
+            "videos": counts["videos"],
+            "video_frames": counts["videoframes"],
+            "subreddits": len(load_list("subs.txt")),
+            "images_last_minute": self._rate(now, MINUTE, 1),
+            "images_last_hour": self._rate(now, HOUR, 1),
+            "posts_last_minute": self._rate(now, MINUTE, 2),
+            "posts_last_hour": self._rate(now, HOUR, 2),
+        }
+        with self._lock:
+            self._stats = stats
+
+    def _rate(self, now, window, column):
+        """ Rows inserted per window, extrapolated from the samples taken during the last window seconds """
+        first = next(s for s in self._samples if s[0] >= now - window)
+        last = self._samples[-1]
+        if last[0] == first[0]:
+            return 0
+        # Counters start over when the database restarts
+        return max(round((last[column] - first[column]) * window / (last[0] - first[0])), 0)
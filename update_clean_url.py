@@ -1,24 +1,24 @@
-
-
 # alter table imageurls add clean_url TEXT;
 # drop index imageurls_url_index;
-# create index imageurls_clean_url_index on imageurls (clean_url);
+# (imageurls_clean_url_index is created by migrations.py)
+#
+# usage: python update_clean_url.py [worker processes]
 
+import sys
+
+import backfill
 from DB import DB
 from common import DBFILE
 from util import clean_url
 
-db = DB(DBFILE)
-with db.get_conn() as conn:
-    update_map = list()
-    for row in conn.query("SELECT id, url FROM ir.public.imageurls"):
-        update_map.append((row[0], clean_url(row[1])))
 
-print("Updating %s imageurls" % len(update_map))
-input("Continue?")
+def transform(row):
+    return clean_url(row[1]),
+
 
-with db.get_conn() as conn:
-    for i, update in enumerate(update_map):
-        conn.exec("UPDATE imageurls SET clean_url = %s WHERE id=%s", (update[1], update[0]))
-        print("%08d/%08d" % (i, len(update_map)))
+if __name__ == "__main__":
+    db = DB(DBFILE)
+    input("Continue?")
 
+    backfill.run(db, "imageurls_clean_url", "imageurls", ["url"], backfill.update_columns("imageurls", ["clean_url"]),
+                 transform, workers=int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -0,0 +1,21 @@
+
+# Fills the full-text search columns of existing posts and comments (added by migration 2 of migrations.py)
+
+import backfill
+from DB import DB, POST_TSV, COMMENT_TSV
+from common import DBFILE
+
+
+def tsv_writer(table, document):
+    def write(cur, rows):
+        cur.execute("UPDATE %s SET tsv = %s WHERE id = ANY(%%s)" % (table, document), ([row[0] for row in rows],))
+    return write
+
+
+if __name__ == "__main__":
+    db = DB(DBFILE)
+    input("Continue?")
+
+    backfill.run(db, "posts_tsv", "posts", [], tsv_writer("posts", POST_TSV % ("title", "text")), where="tsv IS NULL")
+    backfill.run(db, "comments_tsv", "comments", [], tsv_writer("comments", COMMENT_TSV % ("body",)),
+                 where="tsv IS NULL")
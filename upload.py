@@ -2,16 +2,17 @@ import base64
 import json
 
 import binascii
-from flask import Blueprint, Response, request
+from flask import Blueprint, request
 
 from DB import DB
-from common import DBFILE
+from common import DBFILE, DBFILE_READ
 from common import logger
 from img_util import get_hash, image_from_buffer
-from search import MAX_DISTANCE, SearchResults
+from search import MAX_DISTANCE, MAX_K, DEFAULT_K, SearchResults, get_similar_images, \
+    results_response
 
 upload_page = Blueprint('upload', __name__, template_folder='templates')
-db = DB(DBFILE)
+db = DB(DBFILE, read_db_file=DBFILE_READ)
 
 
 @upload_page.route("/upload", methods=["POST"])
@@ -28,19 +29,28 @@ def upload():
                 distance = 0
         else:
             distance = 0
+
+        if "k" in request.form:
+            try:
+                k = max(min(int(request.form["k"]), MAX_K), 1)
+            except:
+                k = DEFAULT_K
+        else:
+            k = DEFAULT_K
         logger.info("Paste upload with distance %d" % (distance, ))
 
         image_buffer = base64.b64decode(request.form["data"][request.form["data"].index(","):])
         image = image_from_buffer(image_buffer)
         image_hash = get_hash(image)
 
-        images = db.get_similar_images(image_hash, distance)
+        images, partial = get_similar_images(image_hash, distance, k)
         if images:
-            results = SearchResults(db.build_result_for_images(images),
-                                    url="hash:" + binascii.hexlify(image_hash).decode('ascii')
+            results = SearchResults(db.build_result_for_images(images, dict(images)),
+                                    url="hash:" + binascii.hexlify(image_hash).decode('ascii'),
+                                    partial=partial
                                     )
         else:
-            results = SearchResults([])
+            results = SearchResults([], partial=partial)
 
-        return Response(results.json(), mimetype="application/json")
+        return results_response(results, request.form.get("format") == "compact")
 
@@ -3,9 +3,9 @@ import json
 from flask import Blueprint, Response
 
 from DB import DB
-from common import DBFILE, cache
+from common import DBFILE, DBFILE_READ, cache
 
-db = DB(DBFILE)
+db = DB(DBFILE, read_db_file=DBFILE_READ)
 video_thumbs = Blueprint('video_thumbs', __name__, template_folder='templates')
 
 
@@ -9,7 +9,7 @@ from threading import Thread
 from PIL import Image
 
 from common import logger, TN_SIZE
-from img_util import get_hash, image_from_buffer
+from img_util import get_hashes, image_from_buffer
 
 CHUNK_LENGTH = 1024 * 24
 
@@ -48,7 +48,7 @@ def info_from_video_buffer(video_buffer, ext, disk=False):
         feeding_thread = Thread(target=feed_buffer_to_process, args=(video_buffer, p))
         feeding_thread.start()
     try:
-        frames = dict()
+        images = []
         image_buffer = BytesIO()
         last_byte_was_marker_byte = False
 
@@ -67,7 +67,7 @@ def info_from_video_buffer(video_buffer, ext, disk=False):
                         im = image_from_buffer(image_buffer.getvalue())
                         im.thumbnail((TN_SIZE, TN_SIZE), Image.ANTIALIAS)
 
-                        frames[get_hash(im)] = im
+                        images.append(im)
 
                         image_buffer = BytesIO()
                         last_image_offset = offset + 1
@@ -76,6 +76,8 @@ def info_from_video_buffer(video_buffer, ext, disk=False):
             image_buffer.write(chunk[last_image_offset:])
             chunk = p.stdout.read(CHUNK_LENGTH)
 
+        frames = dict(zip(get_hashes(images), images))
+
         if not frames and not disk and ext == "mp4":
             return info_from_video_buffer(video_buffer, ext, True)
 